@@ -1,10 +1,15 @@
-from scheduler.node import enode, const
+from scheduler.node import NodeFactory
 from scheduler.dijkstra import DijkstraSchedule
+from scheduler.peephole import optimize
+from scheduler.simulator import op_signatures
 import sys
 import cProfile
 
 
 def _erc20_example() -> DijkstraSchedule:
+    dag = NodeFactory()
+    enode, const = dag.enode, dag.const
+
     frm = enode('calldataload', const('0x04'))
     to = enode('calldataload', const('0x24'))
     amt = enode('calldataload', const('0x44'))
@@ -46,6 +51,9 @@ def _erc20_example() -> DijkstraSchedule:
 
 
 def _existing_vars_op_example() -> DijkstraSchedule:
+    dag = NodeFactory()
+    enode = dag.enode
+
     a, b, c, d = map(enode, 'abcd')
     mstore = enode('mstore', a, b)
     pop_c = enode('pop', c)
@@ -58,6 +66,9 @@ def _existing_vars_op_example() -> DijkstraSchedule:
 
 
 def _simple_store() -> DijkstraSchedule:
+    dag = NodeFactory()
+    enode = dag.enode
+
     to = enode('to')
     mod = enode('mod', to)
     store = enode('store', to, mod)
@@ -70,6 +81,9 @@ def _simple_store() -> DijkstraSchedule:
 
 
 def _weth_withdraw_example() -> DijkstraSchedule:
+    dag = NodeFactory()
+    enode, const = dag.enode, dag.const
+
     frm = const('caller')
     to = enode('calldataload', const('0x04'))
     amt = enode('calldataload', const('0x24'))
@@ -114,11 +128,17 @@ def main():
     assert scheduler.solution, f'No solutions'
 
     print(f'weight: {scheduler.best_weight}')
-    print(f'input stack: {scheduler.target_input_symbols}\n')
+    print(f'input stack: {scheduler.input_layout}\n')
 
     for solution in scheduler.solution:
         print(solution)
 
+    start = scheduler.start_state
+    peephole = optimize(scheduler.solution, op_signatures(start.stack, start.effects_to_undo))
+    print(f'\npeephole: saved weight {peephole.weight_saved}, gas {peephole.gas_saved} ({peephole.rewrites} rewrites)')
+    if peephole.rewrites:
+        print(' '.join(peephole.ops))
+
 
 if __name__ == '__main__':
     if '--profile' in sys.argv:
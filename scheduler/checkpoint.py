@@ -0,0 +1,126 @@
+import gzip
+import json
+import os
+import signal
+from abc import ABC, abstractmethod
+from typing import Iterable, Optional
+from .node import EffectfulNode
+from .search import ScheduleSearch
+from .serialize import NodeTable, decode_nodes
+from .stack import Stack
+
+
+CHECKPOINT_VERSION = 2
+
+# (stack ids, effects to undo ids)
+EncodedState = tuple[list[int], list[int]]
+
+
+class CheckpointError(Exception):
+    pass
+
+
+class CheckpointedSearch(ScheduleSearch, ABC):
+    '''
+    Search engine that can write its state to `checkpoint_path` every
+    `checkpoint_every` expansions and/or whenever `checkpoint_signal` is
+    received. Engines call `save_checkpoint` between expansions once
+    `checkpoint_due`.
+    '''
+    checkpoint_path: Optional[str]
+    checkpoint_every: Optional[int]
+    checkpoint_signal: Optional[int]
+    checkpoint_requested: bool
+
+    def _setup_checkpoints(
+        self,
+        checkpoint_path: Optional[str],
+        checkpoint_every: Optional[int],
+        checkpoint_signal: Optional[int],
+    ):
+        assert checkpoint_path is not None or (checkpoint_every is None and checkpoint_signal is None), \
+            'Checkpoint interval or signal without checkpoint path'
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_signal = checkpoint_signal
+        self.checkpoint_requested = False
+
+    def search(self):
+        if self.checkpoint_signal is None:
+            return self._search()
+
+        def request_checkpoint(*_):
+            self.checkpoint_requested = True
+
+        prev_handler = signal.signal(self.checkpoint_signal, request_checkpoint)
+        try:
+            self._search()
+        finally:
+            signal.signal(self.checkpoint_signal, prev_handler)
+
+    @abstractmethod
+    def _search(self):
+        pass
+
+    def checkpoint_due(self) -> bool:
+        if self.checkpoint_requested:
+            return True
+        return self.checkpoint_every is not None and self.expansions % self.checkpoint_every == 0
+
+    @abstractmethod
+    def save_checkpoint(self, path: Optional[str] = None):
+        pass
+
+
+class StateEncoder:
+    '''
+    Encodes search states (anything with `stack` and `effects_to_undo`) as
+    lists of node ids. Node hashes are salted per process so states can't be
+    pickled as is when resuming elsewhere.
+    '''
+    table: NodeTable
+
+    def __init__(self) -> None:
+        self.table = NodeTable()
+
+    def encode(self, state) -> EncodedState:
+        return list(self.table.ids(state.stack)), list(self.table.ids(state.effects_to_undo))
+
+    def nodes(self) -> dict:
+        return self.table.to_json()
+
+
+class StateDecoder:
+    enodes: list[EffectfulNode]
+
+    def __init__(self, nodes: dict) -> None:
+        self.enodes = decode_nodes(nodes)
+
+    def decode(self, state_cls, encoded: EncodedState):
+        stack_ids, effect_ids = encoded
+        return state_cls(
+            Stack(self.lookup(stack_ids)),
+            self.lookup(effect_ids)
+        )
+
+    def lookup(self, ids: Iterable[int]) -> tuple[EffectfulNode, ...]:
+        return tuple(self.enodes[i] for i in ids)
+
+
+def write_checkpoint(path: str, kind: str, data: dict):
+    data = {'version': CHECKPOINT_VERSION, 'kind': kind, **data}
+    # Write then rename so a pre-empted write never clobbers the last good checkpoint.
+    tmp_path = f'{path}.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def read_checkpoint(path: str, kind: str) -> dict:
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('version') != CHECKPOINT_VERSION:
+        raise CheckpointError(f'Unsupported checkpoint version {data.get("version")!r}')
+    if data.get('kind') != kind:
+        raise CheckpointError(f'Expected {kind} checkpoint, got {data.get("kind")!r}')
+    return data
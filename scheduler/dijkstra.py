@@ -1,104 +1,11 @@
 from collections import defaultdict
-from typing import Counter, Generator, Optional
-from attrs import frozen, define
-from .node import EffectfulNode, Node
+from typing import Counter, Iterable, Optional, Sequence
+from attrs import define
+from .checkpoint import CheckpointedSearch, StateDecoder, StateEncoder, read_checkpoint, write_checkpoint
+from .greedy import FallbackSearch
+from .node import EffectfulNode
+from .search import SearchState
 from .stack import Stack
-from .swap import get_swaps
-
-
-MAX_DUP = 16
-
-
-SearchPath = tuple['SearchState', int, list[str]]
-
-
-@frozen
-class SearchState:
-    stack: Stack[EffectfulNode]
-    effects_to_undo: tuple[EffectfulNode, ...]
-
-    # def __init__(
-    #     self,
-    #     stack: Stack[EffectfulNode],
-    #     effects_to_undo: tuple[EffectfulNode, ...]
-    # ) -> None:
-    #     self.stack = stack
-    #     self.effects_to_undo = effects_to_undo
-
-    # def __hash__(self) -> int:
-    #     return hash((self.stack, self.effects_to_undo))
-
-    def has_dependency(self, node: Node) -> bool:
-        return not node.is_constant and any(
-            value.has_dependency(node)
-            for value in self.stack
-        ) or any(
-            effect.has_dependency(node)
-            for effect in self.effects_to_undo
-        )
-
-    def undo_effect(self, effect: EffectfulNode) -> SearchPath:
-        assert effect in self.effects_to_undo
-        i = self.effects_to_undo.index(effect)
-        new_effects = self.effects_to_undo[:i] + self.effects_to_undo[i+1:]
-
-        ops: list[str] = []
-        new_state = self._undo_node(
-            self.stack,
-            new_effects,
-            ops,
-            effect
-        )
-        return new_state, 0, ops
-
-    def undo_node(self, enode: EffectfulNode) -> SearchPath:
-        stack, swap_op = self.stack.swap_to_top(enode)
-        ops = []
-        weight = 0
-        if swap_op is not None:
-            ops.append(swap_op)
-            weight += 1
-        stack, value = stack.pop()
-        assert value == enode
-        new_state = self._undo_node(stack, self.effects_to_undo, ops, enode)
-        return new_state, weight, ops
-
-    def dedup(self, enode: EffectfulNode, depth: int) -> SearchPath:
-        # log.debug(f'Deduping {enode} ({depth}) from {self.stack.values}')
-        stack = self.stack
-        if depth != 0:
-            stack, op = stack.swap(depth)
-            ops = [op]
-            weight = 1
-        else:
-            ops = []
-            weight = 0
-        # TODO: Dedup based on first index within 16 range
-        dedup_index = stack.values.index(enode)
-        assert dedup_index != len(self.stack) - 1
-        stack, popped_value = stack.pop()
-        assert popped_value == enode
-        dup_depth = len(stack) - dedup_index
-        assert dup_depth in range(1, MAX_DUP + 1)
-        ops.append(f'dup{dup_depth}')
-
-        new_state = SearchState(stack, self.effects_to_undo)
-
-        return new_state, weight, ops
-
-    @classmethod
-    def _undo_node(
-        cls,
-        stack: Stack[EffectfulNode],
-        effects_to_undo: tuple[EffectfulNode, ...],
-        ops: list[str],
-        enode: EffectfulNode
-    ) -> 'SearchState':
-        stack = stack.push_onto(enode.node.operands[::-1])
-        for effect in enode.post_effects:
-            effects_to_undo += (effect,)
-        ops.append(enode.name)
-        return SearchState(stack, effects_to_undo)
 
 
 @define
@@ -119,33 +26,50 @@ def count_nodes(counts: Counter[EffectfulNode], enode: EffectfulNode):
         count_nodes(counts, effect)
 
 
-class DijkstraSchedule:
-    target_input_symbols: list[str]
-    input_value_counts: Counter[str]
-    input_value_counts_frozen: frozenset[tuple[str, int]]
-
+class DijkstraSchedule(FallbackSearch, CheckpointedSearch):
+    start_state: SearchState
     explored: dict[SearchState, Explored]
     weight_to_explored: dict[int, list[Explored]]
-    best_weight: int
-    solution: Optional[list[str]]
+    min_weight: int
 
     def __init__(
         self,
         target_input_symbols: list[str],
         start_output_stack: list[EffectfulNode],
         start_done_effects: list[EffectfulNode],
+        checkpoint_path: Optional[str] = None,
+        checkpoint_every: Optional[int] = None,
+        checkpoint_signal: Optional[int] = None,
+        upper_bound: Optional[int] = None,
+        seed_upper_bound: bool = True,
+        max_expansions: Optional[int] = None,
+        free_input_layout: bool = False,
+        input_order: Iterable[Sequence[str]] = (),
     ) -> None:
-        self.explored = {}
-        self.weight_to_explored = defaultdict(list)
-        self.best_weight = 0
-
-        self.target_input_symbols = target_input_symbols
-        self.input_value_counts = Counter(target_input_symbols)
-        self.input_value_counts_frozen = frozenset(
-            self.input_value_counts.items()
-        )
-
-        start_state = SearchState(
+        '''
+        If `checkpoint_path` is set the search state is written there every
+        `checkpoint_every` expanded states and/or whenever `checkpoint_signal`
+        is received, see `DijkstraSchedule.resume`.
+
+        States heavier than `upper_bound` are never inserted. With
+        `seed_upper_bound` a `GreedySchedule` tightens the bound and its
+        schedule is used as the result if the search is aborted after
+        `max_expansions`.
+
+        With `free_input_layout` the inputs may end up in any order satisfying
+        the `input_order` constraints, the chosen one is `input_layout`. With
+        more than `MAX_EXHAUSTIVE_LAYOUT` inputs and constraints it isn't
+        necessarily the cheapest one, then `exact_layouts` is `False` and the
+        schedule not necessarily optimal.
+        '''
+        self._setup(target_input_symbols)
+        self._setup_checkpoints(checkpoint_path, checkpoint_every, checkpoint_signal)
+        self._setup_input_layout(free_input_layout, input_order)
+        self._setup_fallback(upper_bound, max_expansions)
+        if seed_upper_bound:
+            self.seed_fallback(start_output_stack, start_done_effects)
+
+        self.start_state = start_state = SearchState(
             Stack(tuple(start_output_stack)),
             tuple(start_done_effects),
         )
@@ -161,8 +85,14 @@ class DijkstraSchedule:
 
         self.search()
 
-    def search(self):
-        while not (top := self.pop_best()).is_end:
+    def _setup(self, target_input_symbols: list[str]):
+        super()._setup(target_input_symbols)
+        self.explored = {}
+        self.weight_to_explored = defaultdict(list)
+        self.min_weight = 0
+
+    def _search(self):
+        while (top := self.pop_best()) is not None and not top.is_end:
             prev_state = top.state
             for next_path in self.next_states(prev_state):
                 if next_path is None:
@@ -171,6 +101,8 @@ class DijkstraSchedule:
                 explored_next = self.explored.get(next_state)
                 is_end, added_weight = self.complete_for_end(next_state, ops)
                 weight = top.weight + delta_weight + added_weight
+                if self.upper_bound is not None and weight > self.upper_bound:
+                    continue
                 if explored_next is None:
                     self.insert_new(Explored(
                         next_state,
@@ -190,11 +122,124 @@ class DijkstraSchedule:
                     #     f'Discarded worse path to {next_state} (from: {prev_state}, ops: {ops})'
                     # )
                     pass
-            self._search_next_best_weight()
+            self._search_next_min_weight()
+            self.expansions += 1
+            if self.checkpoint_due():
+                self.save_checkpoint()
+            if self.max_expansions is not None and self.expansions >= self.max_expansions:
+                return self.abort()
+
+        # An empty queue proves there is no schedule (within `upper_bound`).
+        if top is not None:
+            self.put_together_solution(top)
+
+    def abort(self):
+        '''
+        Falls back to the greedy schedule (if any) without an optimal one. With
+        a `checkpoint_path` the search is saved first so it can be resumed.
+        '''
+        if self.checkpoint_path is not None:
+            self.save_checkpoint()
+        super().abort()
+
+    #########################
+    ###### CHECKPOINTS ######
+    #########################
 
-        self.put_together_solution(top)
+    def save_checkpoint(self, path: Optional[str] = None):
+        '''
+        Must only be called between expansions. The explored table is stored in
+        insertion order and the buckets in queue order so a resumed search
+        breaks ties exactly like the original one would have.
+        '''
+        if path is None:
+            path = self.checkpoint_path
+        assert path is not None, 'No checkpoint path'
+
+        encoder = StateEncoder()
+        indices = {state: i for i, state in enumerate(self.explored)}
+        states = []
+        entries = []
+        for explored in self.explored.values():
+            states.append(encoder.encode(explored.state))
+            entries.append([
+                indices[explored.prev_state],
+                explored.is_end,
+                explored.weight,
+                explored.ops_to_prev
+            ])
+        queue = [
+            [weight, [indices[explored.state] for explored in with_weight]]
+            for weight, with_weight in self.weight_to_explored.items()
+            if with_weight
+        ]
+
+        write_checkpoint(path, 'dijkstra', {
+            'target_input_symbols': self.target_input_symbols,
+            'nodes': encoder.nodes(),
+            'states': states,
+            'explored': entries,
+            'queue': queue,
+            'min_weight': self.min_weight,
+            'expansions': self.expansions,
+            'upper_bound': self.upper_bound,
+            'fallback_weight': self.fallback_weight,
+            'fallback_solution': self.fallback_solution,
+            'fallback_layout': self.fallback_layout,
+            'free_input_layout': self.free_input_layout,
+            'input_order': self.input_order,
+            'exact_layouts': self.exact_layouts,
+        })
+        self.checkpoint_requested = False
+
+    @classmethod
+    def resume(
+        cls,
+        path: str,
+        checkpoint_path: Optional[str] = None,
+        checkpoint_every: Optional[int] = None,
+        checkpoint_signal: Optional[int] = None,
+        max_expansions: Optional[int] = None,
+    ) -> 'DijkstraSchedule':
+        '''
+        Continues the search saved at `path`, possibly written by another
+        process or machine. Checkpointing isn't resumed unless configured
+        again. The resumed search may expand up to `max_expansions` more
+        states, the budget of the original one doesn't carry over.
+        '''
+        data = read_checkpoint(path, 'dijkstra')
+        schedule = cls.__new__(cls)
+        schedule._setup(data['target_input_symbols'])
+        schedule._setup_checkpoints(checkpoint_path, checkpoint_every, checkpoint_signal)
+        schedule._setup_input_layout(data['free_input_layout'], data['input_order'])
+        schedule.exact_layouts = data['exact_layouts']
+        schedule.expansions = data['expansions']
+        if max_expansions is not None:
+            max_expansions += schedule.expansions
+        schedule._setup_fallback(data['upper_bound'], max_expansions)
+        schedule.fallback_weight = data['fallback_weight']
+        schedule.fallback_solution = data['fallback_solution']
+        schedule.fallback_layout = data['fallback_layout']
+
+        decoder = StateDecoder(data['nodes'])
+        states = [decoder.decode(SearchState, encoded) for encoded in data['states']]
+        schedule.start_state = states[0]
+        for state, (prev_index, is_end, weight, ops) in zip(states, data['explored']):
+            schedule.explored[state] = Explored(state, states[prev_index], is_end, weight, ops, 0)
+        for weight, indices in data['queue']:
+            with_weight = schedule.weight_to_explored[weight]
+            for index_in_queue, i in enumerate(indices):
+                explored = schedule.explored[states[i]]
+                explored.index_in_queue = index_in_queue
+                with_weight.append(explored)
+        schedule.min_weight = data['min_weight']
+
+        schedule.search()
+        return schedule
 
     def put_together_solution(self, top: Explored):
+        self.best_weight = top.weight
+        self.input_layout = self.input_layout_for(top.state)
         self.solution = []
         self.solution.extend(top.ops_to_prev[::-1])
         explored = top
@@ -202,90 +247,13 @@ class DijkstraSchedule:
             self.solution.extend(prev.ops_to_prev[::-1])
             explored = prev
 
-    def next_states(self, state: SearchState) -> Generator[Optional[SearchPath], None, None]:
-        # log.debug(f'Getting next states from: {state}')
-
-        # Undo dup top of stack
-        if (top := state.stack.peek()) is not None:
-            yield self.undo_dup(state, top, 0)
-            yield self.undo_node(state, top)
-
-        # Undo Effect
-        for effect in state.effects_to_undo:
-            # log.debug(f'undoing effect {effect}')
-            yield state.undo_effect(effect)
-
-        # Undo Node
-        for value in state.stack.tail():
-            yield self.undo_node(state, value)
-
-        # Undo Dup
-        for depth, node in enumerate(reversed(state.stack.tail()), start=1):
-            if (next_state := self.undo_dup(state, node, depth)) is not None:
-                yield next_state
-
-        # log.debug(f'End of next states')
-        # TODO
-        yield state, 3, []
-
-    def undo_node(self, state: SearchState, enode: EffectfulNode) -> Optional[SearchPath]:
-        if self.is_input_symbol(enode):
-            return None
-        if self.still_many_on_stack(state, enode):
-            return None
-        if state.has_dependency(enode.node):
-            return None
-        # log.debug(f'undoing node {enode}')
-        return state.undo_node(enode)
-
-    def still_many_on_stack(self, state: SearchState, enode: EffectfulNode) -> bool:
-        return not enode.is_constant and state.stack.count(enode, max_count=2) > 1
-
-    def is_input_symbol(self, enode: EffectfulNode) -> bool:
-        return enode.name in self.target_input_symbols
-
-    def undo_dup(self, state: SearchState, enode: EffectfulNode, depth: int) -> Optional[SearchPath]:
-        if enode.is_constant:
-            return None
-        count = state.stack.count(enode)
-        if count == 1:
-            return None
-        if self.input_value_counts[enode.name] >= count:
-            return None
-        if state.has_dependency(enode.node):
-            return None
-        # log.debug(f'deduping {enode} at depth {depth}')
-        return state.dedup(enode, depth)
-
-    def complete_for_end(self, state: SearchState, ops: list[str]) -> tuple[bool, int]:
-        if not self.is_end(state):
-            return False, 0
-
-        weight = 0
-        names = [value.name for value in state.stack]
-        for swap_index in get_swaps(self.target_input_symbols[::-1], names[::-1]):
-            ops.append(f'swap{swap_index}')
-            weight += 1
-
-        return True, weight
-
-    def is_end(self, state: SearchState) -> bool:
-        if state.effects_to_undo or len(state.stack) != len(self.target_input_symbols):
-            return False
-
-        state_value_counts: Counter[str] = Counter(map(
-            lambda enode: enode.name,
-            state.stack
-        ))
-
-        return frozenset(state_value_counts.items()) == self.input_value_counts_frozen
-
     #########################
     #### PRIORITY QUEUE #####
     #########################
 
-    def pop_best(self) -> Explored:
-        return self.weight_to_explored[self.best_weight].pop()
+    def pop_best(self) -> Optional[Explored]:
+        with_weight = self.weight_to_explored[self.min_weight]
+        return with_weight.pop() if with_weight else None
 
     def insert_new(self, explored: Explored):
         self.explored[explored.state] = explored
@@ -306,8 +274,10 @@ class DijkstraSchedule:
         with_weight = self.weight_to_explored[explored.weight]
         explored.index_in_queue = len(with_weight)
         with_weight.append(explored)
-        self.best_weight = min(self.best_weight, explored.weight)
+        self.min_weight = min(self.min_weight, explored.weight)
 
-    def _search_next_best_weight(self):
-        while not self.weight_to_explored[self.best_weight]:
-            self.best_weight += 1
+    def _search_next_min_weight(self):
+        # Stop at the heaviest possible weight in case the queue ran empty.
+        max_weight = max(self.weight_to_explored) if self.upper_bound is None else self.upper_bound
+        while not self.weight_to_explored[self.min_weight] and self.min_weight <= max_weight:
+            self.min_weight += 1
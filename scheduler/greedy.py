@@ -0,0 +1,162 @@
+from typing import Generator, Iterable, Iterator, Optional, Sequence
+from .node import EffectfulNode
+from .search import ScheduleSearch, SearchPath, SearchState
+from .stack import Stack
+
+
+# Expansion budget per value or effect the schedule has to produce, a
+# schedule that needs no backtracking takes about one expansion each.
+STEPS_PER_USE = 4
+
+
+def count_uses(start_output_stack: Iterable[EffectfulNode], start_done_effects: Iterable[EffectfulNode]) -> int:
+    '''Number of values and effects a schedule produces, shared ones counted once per use.'''
+    work = [*start_output_stack, *start_done_effects]
+    uses = len(work)
+    seen: set[EffectfulNode] = set()
+    while work:
+        enode = work.pop()
+        if enode in seen:
+            continue
+        seen.add(enode)
+        uses += len(enode.node.operands) + len(enode.post_effects)
+        work.extend(enode.node.operands)
+        work.extend(enode.post_effects)
+    return uses
+
+
+class GreedySchedule(ScheduleSearch):
+    '''
+    Greedy list scheduler: always takes the first zero weight successor (or
+    the cheapest one if there is none) and only backtracks out of dead ends.
+    Doesn't find the optimum but a valid schedule in about one step per op,
+    its weight is an upper bound for the exact engines.
+
+    Backtracking is limited to `max_steps` expanded states (`STEPS_PER_USE`
+    per value and effect by default), `weight` is `None` if no schedule was
+    found within them.
+    '''
+    start_state: SearchState
+    max_steps: int
+    weight: Optional[int]
+    solution: Optional[list[str]]
+    input_layout: Optional[list[str]]
+
+    def __init__(
+        self,
+        target_input_symbols: list[str],
+        start_output_stack: list[EffectfulNode],
+        start_done_effects: list[EffectfulNode],
+        free_input_layout: bool = False,
+        input_order: Iterable[Sequence[str]] = (),
+        max_steps: Optional[int] = None,
+    ) -> None:
+        self._setup(target_input_symbols)
+        self._setup_input_layout(free_input_layout, input_order)
+        self.weight = None
+        self.solution = None
+        self.input_layout = None
+        if max_steps is None:
+            max_steps = STEPS_PER_USE * count_uses(start_output_stack, start_done_effects)
+        self.max_steps = max_steps
+
+        self.start_state = SearchState(
+            Stack(tuple(start_output_stack)),
+            tuple(start_done_effects)
+        )
+
+        self.search()
+
+    def search(self):
+        visited: set[SearchState] = {self.start_state}
+        path: list[tuple[int, list[str], Iterator[SearchPath]]] = [
+            (0, [], self.candidates(self.start_state))
+        ]
+        while path and self.expansions < self.max_steps:
+            weight, _, candidates = path[-1]
+            if (candidate := next(candidates, None)) is None:
+                path.pop()
+                continue
+            next_state, delta_weight, ops = candidate
+            if next_state in visited:
+                continue
+            visited.add(next_state)
+            self.expansions += 1
+            is_end, added_weight = self.complete_for_end(next_state, ops)
+            weight += delta_weight + added_weight
+            if is_end:
+                self.weight = weight
+                self.input_layout = self.input_layout_for(next_state)
+                self.solution = ops[::-1]
+                for _, prev_ops, _ in reversed(path):
+                    self.solution.extend(prev_ops[::-1])
+                return
+            path.append((weight, ops, self.candidates(next_state)))
+
+    def candidates(self, state: SearchState) -> Generator[SearchPath, None, None]:
+        deferred: list[SearchPath] = []
+        for path in self.next_states(state):
+            if path is None:
+                continue
+            if path[1] == 0:
+                yield path
+            else:
+                deferred.append(path)
+        deferred.sort(key=lambda path: path[1])
+        yield from deferred
+
+
+class FallbackSearch(ScheduleSearch):
+    '''
+    Exact engine that may give up before reaching the optimum. States heavier
+    than `upper_bound` are never explored, `seed_fallback` tightens it with a
+    `GreedySchedule` whose schedule `abort` falls back to once the search
+    runs out of `max_expansions`. A search that finishes without a solution
+    proved that none exists (within `upper_bound`), `solution` stays `None`
+    and `aborted` `False`.
+    '''
+    best_weight: Optional[int]
+    solution: Optional[list[str]]
+    input_layout: Optional[list[str]]
+
+    upper_bound: Optional[int]
+    max_expansions: Optional[int]
+    fallback_weight: Optional[int]
+    fallback_solution: Optional[list[str]]
+    fallback_layout: Optional[list[str]]
+    aborted: bool
+
+    def _setup_fallback(self, upper_bound: Optional[int], max_expansions: Optional[int]):
+        self.best_weight = None
+        self.solution = None
+        self.input_layout = None
+
+        self.upper_bound = upper_bound
+        self.max_expansions = max_expansions
+        self.fallback_weight = None
+        self.fallback_solution = None
+        self.fallback_layout = None
+        self.aborted = False
+
+    def seed_fallback(self, start_output_stack: list[EffectfulNode], start_done_effects: list[EffectfulNode]):
+        greedy = GreedySchedule(
+            self.target_input_symbols,
+            start_output_stack,
+            start_done_effects,
+            self.free_input_layout,
+            self.input_order
+        )
+        self.fallback_weight = greedy.weight
+        self.fallback_solution = greedy.solution
+        self.fallback_layout = greedy.input_layout
+        if greedy.weight is not None and (self.upper_bound is None or greedy.weight < self.upper_bound):
+            self.upper_bound = greedy.weight
+
+    def abort(self):
+        '''Falls back to the greedy schedule (if any) without an optimal one.'''
+        self.aborted = True
+        if self.fallback_solution is not None:
+            assert self.fallback_weight is not None
+            self.best_weight = self.fallback_weight
+            self.solution = self.fallback_solution
+            self.input_layout = self.fallback_layout
@@ -1,5 +1,5 @@
 from typing import Optional
-from functools import cache
+from weakref import WeakValueDictionary
 
 
 class Node:
@@ -58,7 +58,6 @@ class EffectfulNode:
     def is_constant(self) -> bool:
         return self.node.is_constant
 
-    @cache
     def has_dependency(self, dependency: 'Node') -> bool:
         return dependency in self.dependencies
 
@@ -81,6 +80,45 @@ def const(name: str) -> EffectfulNode:
     return enode(name, is_constant=True)
 
 
+class NodeFactory:
+    '''
+    Hash-consing factory for the nodes of one DAG: structurally identical
+    nodes built through the same factory are the same object, so identity
+    equality (the default for `Node`/`EffectfulNode`) matches structural
+    equality. Entries are weakly referenced and disappear with the DAG.
+    '''
+    nodes: WeakValueDictionary[tuple[str, tuple[EffectfulNode, ...], bool], Node]
+    enodes: WeakValueDictionary[tuple[Node, tuple[EffectfulNode, ...]], EffectfulNode]
+
+    def __init__(self) -> None:
+        self.nodes = WeakValueDictionary()
+        self.enodes = WeakValueDictionary()
+
+    def node(self, name: str, *operands: EffectfulNode, is_constant: bool = False) -> Node:
+        key = (name, operands, is_constant)
+        if (node := self.nodes.get(key)) is None:
+            node = self.nodes[key] = Node(name, *operands, is_constant=is_constant)
+        return node
+
+    def effectful(self, node: Node, post_effects: tuple[EffectfulNode, ...] = tuple()) -> EffectfulNode:
+        key = (node, post_effects)
+        if (interned := self.enodes.get(key)) is None:
+            interned = self.enodes[key] = EffectfulNode(node, post_effects)
+        return interned
+
+    def enode(self, name: str, *operands, post: Optional[list[EffectfulNode]] = None, is_constant=False) -> EffectfulNode:
+        if post is None:
+            post = []
+
+        return self.effectful(
+            self.node(name, *operands, is_constant=is_constant),
+            post_effects=tuple(post)
+        )
+
+    def const(self, name: str) -> EffectfulNode:
+        return self.enode(name, is_constant=True)
+
+
 class DuplicateNodeError(Exception):
     pass
 
@@ -0,0 +1,50 @@
+import re
+from typing import Optional
+
+
+COMMUTATIVE_OPS = frozenset({'add', 'mul', 'and', 'or', 'xor', 'eq'})
+
+# Zero-input opcodes costing G_base, anything else nullary is pushed with PUSHn.
+ENVIRONMENT_OPS = frozenset({
+    'address', 'origin', 'caller', 'callvalue', 'calldatasize', 'codesize',
+    'gasprice', 'returndatasize', 'coinbase', 'timestamp', 'number',
+    'prevrandao', 'difficulty', 'gaslimit', 'chainid', 'basefee', 'blobbasefee',
+    'pc', 'msize', 'gas',
+})
+
+PUSH0_GAS = 2
+PUSH_GAS = 3
+BASE_GAS = 2
+DUP_GAS = 3
+SWAP_GAS = 3
+
+ZERO_CONSTANT = 'zero'
+
+_STACK_OP = re.compile(r'(swap|dup)(\d+)')
+
+
+def parse_stack_op(op: str) -> Optional[tuple[str, int]]:
+    '''`('swap', n)`/`('dup', n)` for `swapN`/`dupN` ops, otherwise `None`.'''
+    if (m := _STACK_OP.fullmatch(op)) is None:
+        return None
+    return m.group(1), int(m.group(2))
+
+
+def is_commutative(name: str) -> bool:
+    return name in COMMUTATIVE_OPS
+
+
+def constant_gas(name: str) -> int:
+    '''Gas of (re)materializing the constant `name` on top of the stack.'''
+    if name == ZERO_CONSTANT:
+        return PUSH0_GAS
+    if name in ENVIRONMENT_OPS:
+        return BASE_GAS
+    return PUSH_GAS
+
+
+def stack_op_gas(op: str) -> int:
+    if (parsed := parse_stack_op(op)) is None:
+        return 0
+    kind, _ = parsed
+    return SWAP_GAS if kind == 'swap' else DUP_GAS
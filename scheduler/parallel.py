@@ -0,0 +1,415 @@
+'''
+Hash distributed Dijkstra (HDA*) over worker processes.
+
+Every state is owned by one worker, picked by hashing its encoding. A worker
+keeps the best known weight and back link of the states it owns and a bucket
+queue of the ones it hasn't expanded yet. Successors owned by another worker
+are batched and sent to it directly, every pair of workers shares a pipe.
+
+The search runs in synchronous rounds. Each round, every worker expands up
+to `batch_size` of its states with the global minimum weight, then swaps
+batches with every other worker and inserts the successors it received.
+Weights only ever grow along a path, so no state of that weight can still
+be improved. The coordinator only collects each worker's frontier minimum
+and best goal, the search is done once the best goal found weighs at most
+the minimum over all frontiers.
+'''
+import multiprocessing
+import os
+import threading
+import traceback
+from multiprocessing.connection import Connection
+from typing import Any, Iterable, Optional, Sequence
+from attrs import define
+from .greedy import FallbackSearch
+from .node import EffectfulNode
+from .search import ScheduleSearch, SearchState
+from .serialize import NodeTable, decode_nodes
+from .stack import Stack
+
+
+DEFAULT_BATCH_SIZE = 512
+# Seconds a worker gets to exit after being told to stop.
+STOP_TIMEOUT = 5.0
+
+# (stack ids, effects to undo ids) into the shared `NodeTable`
+StateKey = tuple[tuple[int, ...], tuple[int, ...]]
+# (state, weight, prev state, ops to prev, is end)
+Successor = tuple[StateKey, int, StateKey, list[str], bool]
+# (weight, state)
+Goal = tuple[int, StateKey]
+
+
+class ParallelSearchError(Exception):
+    pass
+
+
+def owner_of(key: StateKey, workers: int) -> int:
+    # Hashes of int tuples aren't salted so every process agrees on the owner.
+    return hash(key) % workers
+
+
+@define
+class ShardEntry:
+    state: Optional[SearchState]
+    weight: int
+    prev: StateKey
+    ops_to_prev: list[str]
+    is_end: bool
+    expanded: bool = False
+
+
+class SearchShard(ScheduleSearch):
+    '''The part of the search owned by one worker.'''
+    index: int
+    workers: int
+    enodes: list[EffectfulNode]
+    # Keyed by `id`, every successor is encoded and `EffectfulNode.__hash__`
+    # is a Python call. `enodes` keeps the ids valid.
+    enode_ids: dict[int, int]
+    entries: dict[StateKey, ShardEntry]
+    queue: dict[int, list[StateKey]]
+    upper_bound: Optional[int]
+    best_goal: Optional[Goal]
+
+    def __init__(
+        self,
+        index: int,
+        workers: int,
+        nodes: dict,
+        target_input_symbols: list[str],
+        free_input_layout: bool,
+        input_order: Iterable[Sequence[str]],
+        start_key: StateKey,
+    ) -> None:
+        self._setup(target_input_symbols)
+        self._setup_input_layout(free_input_layout, input_order)
+        self.index = index
+        self.workers = workers
+        self.enodes = decode_nodes(nodes)
+        self.enode_ids = {id(enode): i for i, enode in enumerate(self.enodes)}
+        self.entries = {}
+        self.queue = {}
+        self.upper_bound = None
+        self.best_goal = None
+        if owner_of(start_key, workers) == index:
+            self.insert(start_key, 0, start_key, [], False)
+
+    def encode(self, state: SearchState) -> StateKey:
+        lookup = self.enode_ids.__getitem__
+        return (
+            tuple(map(lookup, map(id, state.stack.values))),
+            tuple(map(lookup, map(id, state.effects_to_undo)))
+        )
+
+    def decode(self, key: StateKey) -> SearchState:
+        stack_ids, effect_ids = key
+        return SearchState(
+            Stack(tuple(self.enodes[i] for i in stack_ids)),
+            tuple(self.enodes[i] for i in effect_ids)
+        )
+
+    def expand(self, bound: int, upper_bound: Optional[int], batch_size: int) -> list[list[Successor]]:
+        '''
+        Expands up to `batch_size` states weighing `bound`. Returns the
+        successors owned by every other worker.
+        '''
+        self.upper_bound = upper_bound
+        outgoing: list[list[Successor]] = [[] for _ in range(self.workers)]
+        expanded = 0
+        while expanded < batch_size and (key := self.pop(bound)) is not None:
+            entry = self.entries[key]
+            entry.expanded = True
+            state = self.decode(key) if entry.state is None else entry.state
+            entry.state = None
+            for next_path in self.next_states(state):
+                if next_path is None:
+                    continue
+                next_state, delta_weight, ops = next_path
+                is_end, added_weight = self.complete_for_end(next_state, ops)
+                weight = entry.weight + delta_weight + added_weight
+                if self.upper_bound is not None and weight > self.upper_bound:
+                    continue
+                next_key = self.encode(next_state)
+                owner = owner_of(next_key, self.workers)
+                if owner == self.index:
+                    self.insert(next_key, weight, key, ops, is_end, next_state)
+                else:
+                    outgoing[owner].append((next_key, weight, key, ops, is_end))
+            expanded += 1
+        self.expansions += expanded
+
+        return outgoing
+
+    def insert(
+        self,
+        key: StateKey,
+        weight: int,
+        prev: StateKey,
+        ops: list[str],
+        is_end: bool,
+        state: Optional[SearchState] = None
+    ):
+        if (entry := self.entries.get(key)) is None:
+            self.entries[key] = ShardEntry(state, weight, prev, ops, is_end)
+        elif weight < entry.weight:
+            assert not entry.expanded and entry.is_end == is_end
+            entry.weight = weight
+            entry.prev = prev
+            entry.ops_to_prev = ops
+        else:
+            return
+        if is_end:
+            if self.best_goal is None or weight < self.best_goal[0]:
+                self.best_goal = weight, key
+        else:
+            # Improved entries are queued again, their stale copies skipped on pop.
+            self.queue.setdefault(weight, []).append(key)
+
+    def is_stale(self, key: StateKey, weight: int) -> bool:
+        entry = self.entries[key]
+        return entry.expanded or entry.weight != weight
+
+    def pop(self, weight: int) -> Optional[StateKey]:
+        with_weight = self.queue.get(weight)
+        while with_weight:
+            key = with_weight.pop()
+            if not self.is_stale(key, weight):
+                return key
+        self.queue.pop(weight, None)
+        return None
+
+    def local_min(self) -> Optional[int]:
+        for weight in sorted(self.queue):
+            with_weight = self.queue[weight]
+            while with_weight and self.is_stale(with_weight[-1], weight):
+                with_weight.pop()
+            if with_weight:
+                return weight
+            del self.queue[weight]
+        return None
+
+    def trace(self, key: StateKey) -> tuple[StateKey, list[str]]:
+        entry = self.entries[key]
+        return entry.prev, entry.ops_to_prev
+
+
+# (local minimum, best goal, states expanded so far, exact layouts)
+RoundSummary = tuple[Optional[int], Optional[Goal], int, bool]
+
+
+def _exchange(peers: dict[int, Connection], outgoing: list[list[Successor]]) -> list[list[Successor]]:
+    '''
+    Sends every peer its batch and receives one from each. Sending happens on
+    a second thread, workers that send before receiving would deadlock once
+    a batch doesn't fit into the pipe buffer.
+    '''
+    if not peers:
+        return []
+
+    def send_all():
+        for owner, peer in peers.items():
+            peer.send(outgoing[owner])
+
+    sender = threading.Thread(target=send_all)
+    sender.start()
+    try:
+        return [peer.recv() for peer in peers.values()]
+    finally:
+        sender.join()
+
+
+def _run_round(
+    shard: SearchShard,
+    peers: dict[int, Connection],
+    bound: int,
+    upper_bound: Optional[int],
+    batch_size: int
+) -> RoundSummary:
+    try:
+        outgoing = shard.expand(bound, upper_bound, batch_size)
+    except Exception:
+        # Every peer waits for a batch from this worker.
+        _exchange(peers, [[] for _ in range(shard.workers)])
+        raise
+    expansions = shard.expansions
+    for successors in _exchange(peers, outgoing):
+        for successor in successors:
+            shard.insert(*successor)
+    return shard.local_min(), shard.best_goal, expansions, shard.exact_layouts
+
+
+def _serve(connection: Connection, peers: dict[int, Connection], index: int, workers: int, config: dict):
+    shard = SearchShard(index, workers, **config)
+    while True:
+        kind, *args = connection.recv()
+        if kind == 'stop':
+            break
+        result: RoundSummary | tuple[StateKey, list[str]]
+        try:
+            if kind == 'round':
+                result = _run_round(shard, peers, *args)
+            elif kind == 'trace':
+                result = shard.trace(*args)
+            else:
+                raise ParallelSearchError(f'Unknown message {kind!r}')
+        except Exception:
+            connection.send((False, traceback.format_exc()))
+        else:
+            connection.send((True, result))
+    connection.close()
+    for peer in peers.values():
+        peer.close()
+
+
+class ParallelDijkstraSchedule(FallbackSearch):
+    '''
+    Same result weight as `DijkstraSchedule`, with the states spread over
+    `workers` processes (one per core by default). Checkpointing isn't
+    supported.
+    '''
+    workers: int
+    batch_size: int
+    start_method: Optional[str]
+    table: NodeTable
+    start_key: StateKey
+    rounds: int
+
+    def __init__(
+        self,
+        target_input_symbols: list[str],
+        start_output_stack: list[EffectfulNode],
+        start_done_effects: list[EffectfulNode],
+        workers: Optional[int] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        upper_bound: Optional[int] = None,
+        seed_upper_bound: bool = True,
+        max_expansions: Optional[int] = None,
+        free_input_layout: bool = False,
+        input_order: Iterable[Sequence[str]] = (),
+        start_method: Optional[str] = None,
+    ) -> None:
+        '''
+        `upper_bound`, `seed_upper_bound`, `max_expansions` and the input
+        layout options (and `exact_layouts`) behave as for `DijkstraSchedule`.
+        Expansions are only counted between rounds, so `max_expansions` may be
+        overshot by up to `workers * batch_size`.
+        '''
+        self._setup(target_input_symbols)
+        self._setup_input_layout(free_input_layout, input_order)
+        self._setup_fallback(upper_bound, max_expansions)
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.start_method = start_method
+        self.rounds = 0
+
+        if seed_upper_bound:
+            self.seed_fallback(start_output_stack, start_done_effects)
+
+        self.table = NodeTable()
+        self.start_key = (self.table.ids(start_output_stack), self.table.ids(start_done_effects))
+
+        self.search()
+
+    def search(self):
+        context = multiprocessing.get_context(self.start_method)
+        config = {
+            'nodes': self.table.to_json(),
+            'target_input_symbols': self.target_input_symbols,
+            'free_input_layout': self.free_input_layout,
+            'input_order': self.input_order,
+            'start_key': self.start_key,
+        }
+        peers: list[dict[int, Connection]] = [{} for _ in range(self.workers)]
+        for index in range(self.workers):
+            for other in range(index + 1, self.workers):
+                peers[index][other], peers[other][index] = context.Pipe()
+        connections: list[Connection] = []
+        processes = []
+        try:
+            for index in range(self.workers):
+                connection, worker_connection = context.Pipe()
+                process = context.Process(
+                    target=_serve,
+                    args=(worker_connection, peers[index], index, self.workers, config),
+                    daemon=True
+                )
+                process.start()
+                worker_connection.close()
+                connections.append(connection)
+                processes.append(process)
+            for worker_peers in peers:
+                for peer in worker_peers.values():
+                    peer.close()
+            self._coordinate(connections)
+        finally:
+            for connection in connections:
+                try:
+                    connection.send(('stop',))
+                except (BrokenPipeError, OSError):
+                    pass
+                connection.close()
+            for process in processes:
+                # A worker stuck waiting for a failed peer's batch never sees the stop.
+                process.join(STOP_TIMEOUT)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+
+    def _coordinate(self, connections: list[Connection]):
+        bound: Optional[int] = 0
+        goal: Optional[Goal] = None
+
+        while goal is None or (bound is not None and bound < goal[0]):
+            if bound is None:
+                # Every frontier is empty, there is no schedule (within `upper_bound`).
+                return
+            if self.max_expansions is not None and self.expansions >= self.max_expansions:
+                return self.abort()
+
+            upper_bound = self.upper_bound
+            if goal is not None and (upper_bound is None or goal[0] < upper_bound):
+                upper_bound = goal[0]
+            for connection in connections:
+                connection.send(('round', bound, upper_bound, self.batch_size))
+
+            local_mins: list[int] = []
+            expansions = 0
+            for connection in connections:
+                local_min, best_goal, worker_expansions, exact_layouts = self.receive(connection)
+                if local_min is not None:
+                    local_mins.append(local_min)
+                if best_goal is not None and (goal is None or best_goal < goal):
+                    goal = best_goal
+                expansions += worker_expansions
+                self.exact_layouts &= exact_layouts
+            bound = min(local_mins, default=None)
+            self.expansions = expansions
+            self.rounds += 1
+
+        self.put_together_solution(connections, goal)
+
+    def receive(self, connection: Connection) -> Any:
+        ok, result = connection.recv()
+        if not ok:
+            raise ParallelSearchError(f'Worker failed:\n{result}')
+        return result
+
+    def put_together_solution(self, connections: list[Connection], goal: Goal):
+        '''Follows the back links from `goal`, asking the owner of each state.'''
+        weight, key = goal
+        self.best_weight = weight
+        self.solution = []
+        while True:
+            connection = connections[owner_of(key, self.workers)]
+            connection.send(('trace', key))
+            prev, ops = self.receive(connection)
+            self.solution.extend(ops[::-1])
+            if prev == key:
+                break
+            key = prev
+
+        enodes = {enode_id: enode for enode, enode_id in self.table.enode_ids.items()}
+        stack_ids, _ = goal[1]
+        end_state = SearchState(Stack(tuple(enodes[i] for i in stack_ids)), ())
+        self.input_layout = self.input_layout_for(end_state)
@@ -0,0 +1,127 @@
+'''
+Pattern driven peephole pass over emitted op sequences. Every rewrite is
+checked with the `StackSimulator` before it's applied so patterns only need
+to be cheap, not sound.
+'''
+from typing import Callable, Optional, Sequence
+from attrs import frozen
+from .opcodes import constant_gas, is_commutative, parse_stack_op, stack_op_gas
+from .simulator import Signature, equivalent
+
+
+MAX_WINDOW = 3
+
+# Gets the tail of the emitted ops, returns how many to replace and with what.
+Rule = Callable[[list[str], dict[str, Signature]], Optional[tuple[int, list[str]]]]
+
+
+@frozen
+class PeepholeResult:
+    ops: list[str]
+    weight_saved: int
+    gas_saved: int
+    rewrites: int
+
+
+def _is_swap(op: str, depth: Optional[int] = None) -> bool:
+    parsed = parse_stack_op(op)
+    return parsed is not None and parsed[0] == 'swap' and (depth is None or parsed[1] == depth)
+
+
+def _is_constant(op: str, signatures: dict[str, Signature]) -> bool:
+    signature = signatures.get(op)
+    return signature is not None and signature.is_constant
+
+
+def cancel_swap_pair(tail: list[str], _) -> Optional[tuple[int, list[str]]]:
+    '''`swapN swapN` => ``'''
+    if len(tail) >= 2 and _is_swap(tail[-1]) and tail[-1] == tail[-2]:
+        return 2, []
+    return None
+
+
+def drop_swap_before_commutative(tail: list[str], signatures: dict[str, Signature]) -> Optional[tuple[int, list[str]]]:
+    '''`swap1 add` => `add`'''
+    if len(tail) >= 2 and _is_swap(tail[-2], 1) and is_commutative(tail[-1]) \
+            and signatures.get(tail[-1], Signature(0, 0)).inputs == 2:
+        return 2, [tail[-1]]
+    return None
+
+
+def drop_swap_after_dup1(tail: list[str], _) -> Optional[tuple[int, list[str]]]:
+    '''`dup1 swap1` => `dup1`'''
+    if len(tail) >= 2 and tail[-2] == 'dup1' and _is_swap(tail[-1], 1):
+        return 2, ['dup1']
+    return None
+
+
+def reorder_constant_pushes(tail: list[str], signatures: dict[str, Signature]) -> Optional[tuple[int, list[str]]]:
+    '''`0x01 zero swap1` => `zero 0x01`, folds a swap fix-up into push order'''
+    if len(tail) >= 3 and _is_swap(tail[-1], 1) \
+            and _is_constant(tail[-2], signatures) and _is_constant(tail[-3], signatures):
+        return 3, [tail[-2], tail[-3]]
+    return None
+
+
+RULES: tuple[Rule, ...] = (
+    cancel_swap_pair,
+    drop_swap_before_commutative,
+    drop_swap_after_dup1,
+    reorder_constant_pushes,
+)
+
+
+def op_gas(op: str, signatures: dict[str, Signature]) -> int:
+    '''Gas of the stack manipulation part of `op`, other ops are never rewritten.'''
+    if _is_constant(op, signatures):
+        return constant_gas(op)
+    return stack_op_gas(op)
+
+
+def ops_gas(ops: Sequence[str], signatures: dict[str, Signature]) -> int:
+    return sum(op_gas(op, signatures) for op in ops)
+
+
+def ops_weight(ops: Sequence[str]) -> int:
+    '''Weight as counted by the search: one per swap.'''
+    return sum(1 for op in ops if _is_swap(op))
+
+
+def optimize(
+    ops: Sequence[str],
+    signatures: dict[str, Signature],
+    rules: Sequence[Rule] = RULES
+) -> PeepholeResult:
+    '''
+    Single left to right pass, each rule only looks at the last `MAX_WINDOW`
+    emitted ops and every rewrite shrinks the output, so the pass is linear
+    in `len(ops)`.
+    '''
+    out: list[str] = []
+    weight_saved = 0
+    gas_saved = 0
+    rewrites = 0
+
+    for op in ops:
+        out.append(op)
+        changed = True
+        while changed:
+            changed = False
+            tail = out[-MAX_WINDOW:]
+            for rule in rules:
+                if (rewrite := rule(tail, signatures)) is None:
+                    continue
+                length, replacement = rewrite
+                assert len(replacement) < length, f'{rule.__name__} does not shrink'
+                window = tail[-length:]
+                if not equivalent(window, replacement, signatures):
+                    continue
+                del out[-length:]
+                out.extend(replacement)
+                weight_saved += ops_weight(window) - ops_weight(replacement)
+                gas_saved += ops_gas(window, signatures) - ops_gas(replacement, signatures)
+                rewrites += 1
+                changed = True
+                break
+
+    return PeepholeResult(out, weight_saved, gas_saved, rewrites)
@@ -1,236 +1,168 @@
-from collections import Counter
-from typing import Generator, Optional, Sequence
-from attrs import frozen
-from .node import Node
+from typing import Iterable, Optional, Sequence
+from attrs import define
+from .checkpoint import CheckpointedSearch, StateDecoder, StateEncoder, read_checkpoint, write_checkpoint
+from .greedy import GreedySchedule
+from .node import EffectfulNode
+from .search import SearchPath, SearchState
 from .stack import Stack
 from .logging import log
-from .swap import get_swaps
 
 
-Trace = tuple[str, ...]
+DEFAULT_MAX_TRANSPOSITIONS = 1 << 20
 
-MAX_DUP = 16
-EFFECT_WRAPPER_NODE = '__effect__'
 
+@define
+class Frame:
+    state: SearchState
+    weight: int
+    parent: Optional['Frame']
+    ops_to_parent: list[str]
+    successors: list[SearchPath]
+    next_successor: int = 0
 
-@frozen
-class SearchState:
-    stack: Stack
-    effects_to_undo: tuple[Node, ...]
-    trace: Trace = tuple()
-    weight: int = 0
 
-    def undo_effect(self, effect: Node) -> 'SearchState':
-
-        assert effect in self.effects_to_undo
-        i = self.effects_to_undo.index(effect)
-        new_effects = self.effects_to_undo[:i] + self.effects_to_undo[i+1:]
-
-        return self._undo_node(
-            self.stack,
-            new_effects,
-            self.trace,
-            self.weight,
-            effect
-        )
-
-    def has_dependency(self, node: Node) -> bool:
-        return not node.is_constant and any(
-            value.has_dependency(node)
-            for value in self.stack
-        ) or any(
-            effect.has_dependency(node)
-            for effect in self.effects_to_undo
-        )
-
-    def undo_node(self, node: Node) -> 'SearchState':
-        stack, swap_op = self.stack.swap_to_top(node)
-        weight = self.weight
-        trace = self.trace
-        if swap_op is not None:
-            trace += (swap_op,)
-            weight += 1
-        stack, value = stack.pop()
-        assert value == node
-        return self._undo_node(stack, self.effects_to_undo, trace, weight, node)
-
-    def dedup(self, value: Node, depth: int) -> 'SearchState':
-        log.debug(f'Deduping {value} ({depth}) from {self.stack.values}')
-        stack = self.stack
-        trace = self.trace
-        weight = self.weight
-        if depth != 0:
-            stack, op = stack.swap(depth)
-            trace += (op,)
-            weight += 1
-        # TODO: Dedup based on first index within 16 range
-        dedup_index = stack.values.index(value)
-        assert dedup_index != len(self.stack) - 1
-        stack, popped_value = stack.pop()
-        assert popped_value == value
-        dup_depth = len(stack) - dedup_index
-        assert dup_depth in range(1, MAX_DUP + 1)
-        trace += (f'dup{dup_depth}', )
-
-        return SearchState(
-            stack,
-            self.effects_to_undo,
-            trace,
-            weight
-        )
-
-    @classmethod
-    def _undo_node(
-        cls,
-        stack: Stack,
-        effects_to_undo: tuple[Node, ...],
-        trace: Trace,
-        weight: int,
-        node: Node
-    ) -> 'SearchState':
-        stack = stack.push_operands_onto(node)
-        if node.operands and stack.peek().name == EFFECT_WRAPPER_NODE:
-            stack, top = stack.pop()
-            for new_effect in top.operands:
-                assert new_effect not in effects_to_undo
-                effects_to_undo += (new_effect,)
-        trace += (node.name,)
-        return SearchState(stack, effects_to_undo, trace, weight)
-
-
-def node_post_effects(name: str, *operands: Node, effects: Optional[Sequence[Node]] = None) -> Node:
-    if effects is None or not effects:
-        return Node(name, *operands)
-    return Node(name, Node(EFFECT_WRAPPER_NODE, *effects), *operands)
-
-
-class Scheduler:
-    target_input_symbols: list[str]
-    input_value_counts: Counter[str]
-    input_value_counts_frozen: frozenset[tuple[str, int]]
+class Scheduler(CheckpointedSearch):
+    '''
+    Depth first branch-and-bound search. The DFS runs on an explicit stack of
+    `Frame`s whose parent links double as the trace. A bounded transposition
+    table remembers the lowest weight each state was reached with, paths
+    reaching a known state at the same or a higher weight are cut.
+    '''
     best_weight: Optional[int] = None
     best_solutions: list[list[str]]
+    best_layouts: list[list[str]]
     optimum_upper_bound: Optional[int]
 
+    frames: list[Frame]
+    transpositions: dict[SearchState, int]
+    max_transpositions: int
+
     def __init__(
         self,
         target_input_symbols: list[str],
-        start_output_stack: list[Node],
-        start_done_effects: list[Node],
-        optimum_upper_bound: Optional[int]
+        start_output_stack: list[EffectfulNode],
+        start_done_effects: list[EffectfulNode],
+        optimum_upper_bound: Optional[int],
+        max_transpositions: int = DEFAULT_MAX_TRANSPOSITIONS,
+        checkpoint_path: Optional[str] = None,
+        checkpoint_every: Optional[int] = None,
+        checkpoint_signal: Optional[int] = None,
+        seed_upper_bound: bool = True,
+        free_input_layout: bool = False,
+        input_order: Iterable[Sequence[str]] = (),
     ) -> None:
+        '''
+        With `seed_upper_bound` a `GreedySchedule` is recorded as the first
+        solution so only strictly better paths are ever expanded.
+
+        With `free_input_layout` the inputs may end up in any order satisfying
+        the `input_order` constraints, `best_layouts` holds the layout chosen
+        for each solution. With more than `MAX_EXHAUSTIVE_LAYOUT` inputs and
+        constraints these aren't necessarily the cheapest ones, then
+        `exact_layouts` is `False` and the solutions not necessarily optimal.
+        '''
         # TODO: Validate no target symbols in effects or output stack nodes
-
-        self.target_input_symbols = target_input_symbols
-        self.input_value_counts = Counter(target_input_symbols)
-        self.input_value_counts_frozen = frozenset(
-            self.input_value_counts.items()
-        )
+        self._setup(target_input_symbols)
+        self._setup_checkpoints(checkpoint_path, checkpoint_every, checkpoint_signal)
+        self._setup_input_layout(free_input_layout, input_order)
         self.best_solutions = []
+        self.best_layouts = []
         self.optimum_upper_bound = optimum_upper_bound
-
-        self.search(SearchState(
+        self.max_transpositions = max_transpositions
+
+        if seed_upper_bound:
+            greedy = GreedySchedule(
+                target_input_symbols,
+                start_output_stack,
+                start_done_effects,
+                free_input_layout,
+                self.input_order
+            )
+            if greedy.weight is not None and greedy.solution is not None:
+                assert greedy.input_layout is not None
+                self.best_weight = greedy.weight
+                self.best_solutions = [greedy.solution]
+                self.best_layouts = [greedy.input_layout]
+
+        self.push_frame(SearchState(
             Stack(tuple(start_output_stack)),
             tuple(start_done_effects)
-        ))
-
-    def search(self, state: SearchState):
-        if not self.weight_better(state.weight):
-            return
-        if self.found_input(state):
-            self.complete_and_record(state)
-            return
-
-        for new_state in self.next_states(state):
-            if new_state is not None:
-                self.search(new_state)
-
-    def next_states(self, state: SearchState) -> Generator[Optional[SearchState], None, None]:
-        log.debug(f'Getting next states from: {state}')
-
-        if self.is_optimal():
-            return
-
-        # Undo dup top of stack
-        if (top := state.stack.peek()) is not None:
-            yield self.undo_dup(state, top, 0)
-            yield self.undo_node(state, top)
-
-        # Undo Effect
-        for effect in state.effects_to_undo:
-            log.debug(f'undoing effect {effect}')
-            yield state.undo_effect(effect)
-
-        # Undo Node
-        for value in state.stack.tail():
-            yield self.undo_node(state, value)
-
-        # Undo Dup
-        for depth, node in enumerate(reversed(state.stack.tail()), start=1):
-            if (next_state := self.undo_dup(state, node, depth)) is not None:
-                yield next_state
-
-        log.debug(f'End of next states')
-        # TODO: pops
-
-    def undo_node(self, state: SearchState, value: Node) -> Optional[SearchState]:
-        if value.name in self.target_input_symbols:
-            return None
-        if not value.is_constant and state.stack.count(value) > 1:
-            return None
-        if state.has_dependency(value):
-            return None
-        log.debug(f'undoing node {value}')
-        return state.undo_node(value)
-
-    def undo_dup(self, state: SearchState, node: Node, depth: int) -> Optional[SearchState]:
-        if node.is_constant:
-            return None
-        count = state.stack.count(node)
-        if count == 1:
-            return None
-        if self.input_value_counts[node.name] >= count:
-            return None
-        if state.has_dependency(node):
-            return None
-        log.debug(f'deduping {node} at depth {depth}')
-        return state.dedup(node, depth)
-
-    def found_input(self, state: SearchState) -> bool:
-        if state.effects_to_undo or len(state.stack) != len(self.target_input_symbols):
+        ), 0, None, [])
+
+        self.search()
+
+    def _setup(self, target_input_symbols: list[str]):
+        super()._setup(target_input_symbols)
+        self.frames = []
+        self.transpositions = {}
+
+    def _search(self):
+        while self.frames and not self.is_optimal():
+            frame = self.frames[-1]
+            if frame.next_successor == len(frame.successors):
+                self.frames.pop()
+                continue
+            next_state, delta_weight, ops = frame.successors[frame.next_successor]
+            frame.next_successor += 1
+
+            is_end, added_weight = self.complete_for_end(next_state, ops)
+            weight = frame.weight + delta_weight + added_weight
+            if not self.weight_better(weight):
+                continue
+            if is_end:
+                self.record(frame, next_state, ops, weight)
+            elif self.transpose(next_state, weight):
+                self.push_frame(next_state, weight, frame, ops)
+                self.expansions += 1
+                if self.checkpoint_due():
+                    self.save_checkpoint()
+
+    def push_frame(self, state: SearchState, weight: int, parent: Optional[Frame], ops: list[str]):
+        self.frames.append(Frame(state, weight, parent, ops, self.ordered_successors(state)))
+
+    def ordered_successors(self, state: SearchState) -> list[SearchPath]:
+        '''Cheapest moves first so good bounds are found early.'''
+        successors = [
+            path
+            for path in self.next_states(state)
+            if path is not None
+        ]
+        successors.sort(key=lambda path: path[1])
+        return successors
+
+    def transpose(self, state: SearchState, weight: int) -> bool:
+        '''Records `weight` for `state`, `False` if it was reached as cheaply before.'''
+        known = self.transpositions.get(state)
+        if known is not None and known <= weight:
             return False
-
-        state_value_counts: Counter[str] = Counter(map(
-            lambda node: node.name,
-            state.stack
-        ))
-
-        return frozenset(state_value_counts.items()) == self.input_value_counts_frozen
+        if known is None and len(self.transpositions) >= self.max_transpositions:
+            # Evict the oldest entry, deep states are inserted last.
+            del self.transpositions[next(iter(self.transpositions))]
+        self.transpositions[state] = weight
+        return True
 
     def is_optimal(self) -> bool:
         return self.optimum_upper_bound is not None\
             and self.best_weight is not None\
             and self.best_weight <= self.optimum_upper_bound
 
-    def complete_and_record(self, state: SearchState):
-        weight = state.weight
-        steps: list[str] = []
-        for swap_index in get_swaps(self.target_input_symbols[::-1], [value.name for value in state.stack][::-1]):
-            steps.append(f'swap{swap_index}')
-            log.debug(f'appended step {steps[-1]}')
-            if not self.weight_better(weight := weight + 1):
-                return
-
-        assert self.weight_better(weight)
-
-        steps.extend(state.trace[::-1])
+    def record(self, frame: Frame, state: SearchState, ops: list[str], weight: int):
+        steps: list[str] = ops[::-1]
+        parent: Optional[Frame] = frame
+        while parent is not None:
+            steps.extend(parent.ops_to_parent[::-1])
+            parent = parent.parent
 
+        layout = self.input_layout_for(state)
+        assert layout is not None
         if self.best_weight is None or self.best_weight > weight:
             self.best_weight = weight
             self.best_solutions = [steps]
+            self.best_layouts = [layout]
         else:
             assert self.best_weight == weight
             self.best_solutions.append(steps)
+            self.best_layouts.append(layout)
 
         log.info(
             f'New solution (weight: {weight},)\n  steps: {" ".join(steps)}'
@@ -238,3 +170,77 @@ class Scheduler:
 
     def weight_better(self, weight: int) -> bool:
         return self.best_weight is None or self.best_weight > weight
+
+    #########################
+    ###### CHECKPOINTS ######
+    #########################
+
+    def save_checkpoint(self, path: Optional[str] = None):
+        '''
+        Stores the current best solutions, the DFS position and the
+        transposition table. Successor lists aren't stored, they are
+        regenerated in the same order when resuming.
+        '''
+        if path is None:
+            path = self.checkpoint_path
+        assert path is not None, 'No checkpoint path'
+
+        encoder = StateEncoder()
+        frames = [
+            [encoder.encode(frame.state), frame.weight, frame.ops_to_parent, frame.next_successor]
+            for frame in self.frames
+        ]
+        transpositions = [
+            [encoder.encode(state), weight]
+            for state, weight in self.transpositions.items()
+        ]
+
+        write_checkpoint(path, 'scheduler', {
+            'target_input_symbols': self.target_input_symbols,
+            'nodes': encoder.nodes(),
+            'frames': frames,
+            'transpositions': transpositions,
+            'max_transpositions': self.max_transpositions,
+            'best_weight': self.best_weight,
+            'best_solutions': self.best_solutions,
+            'best_layouts': self.best_layouts,
+            'free_input_layout': self.free_input_layout,
+            'input_order': self.input_order,
+            'exact_layouts': self.exact_layouts,
+            'optimum_upper_bound': self.optimum_upper_bound,
+            'expansions': self.expansions,
+        })
+        self.checkpoint_requested = False
+
+    @classmethod
+    def resume(
+        cls,
+        path: str,
+        checkpoint_path: Optional[str] = None,
+        checkpoint_every: Optional[int] = None,
+        checkpoint_signal: Optional[int] = None,
+    ) -> 'Scheduler':
+        data = read_checkpoint(path, 'scheduler')
+        scheduler = cls.__new__(cls)
+        scheduler._setup(data['target_input_symbols'])
+        scheduler._setup_checkpoints(checkpoint_path, checkpoint_every, checkpoint_signal)
+        scheduler._setup_input_layout(data['free_input_layout'], data['input_order'])
+        scheduler.exact_layouts = data['exact_layouts']
+        scheduler.expansions = data['expansions']
+        scheduler.max_transpositions = data['max_transpositions']
+        scheduler.best_weight = data['best_weight']
+        scheduler.best_solutions = data['best_solutions']
+        scheduler.best_layouts = data['best_layouts']
+        scheduler.optimum_upper_bound = data['optimum_upper_bound']
+
+        decoder = StateDecoder(data['nodes'])
+        for encoded, weight in data['transpositions']:
+            scheduler.transpositions[decoder.decode(SearchState, encoded)] = weight
+        parent: Optional[Frame] = None
+        for encoded, weight, ops, next_successor in data['frames']:
+            scheduler.push_frame(decoder.decode(SearchState, encoded), weight, parent, ops)
+            parent = scheduler.frames[-1]
+            parent.next_successor = next_successor
+
+        scheduler.search()
+        return scheduler
@@ -0,0 +1,498 @@
+from itertools import permutations
+from typing import Counter, Generator, Iterable, Iterator, Optional, Sequence
+from attrs import define, field, frozen
+from .node import EffectfulNode, Node
+from .opcodes import is_commutative
+from .stack import MAX_VALID_SWAP_DEPTH, Stack
+from .swap import get_swaps
+
+
+MAX_DUP = 16
+# Values of `swapped`, see `ScheduleSearch.operand_orders`.
+DECLARED_ORDER = (False,)
+BOTH_ORDERS = (False, True)
+# Up to this many inputs the cheapest constrained layout is found exhaustively.
+MAX_EXHAUSTIVE_LAYOUT = 7
+
+
+SearchPath = tuple['SearchState', int, list[str]]
+# (removed values, added values, removed effects, added effects)
+StateDelta = tuple[
+    tuple[EffectfulNode, ...],
+    tuple[EffectfulNode, ...],
+    tuple[EffectfulNode, ...],
+    tuple[EffectfulNode, ...],
+]
+# (above, below): every `above` input has to end up above every `below` input.
+InputOrder = tuple[tuple[str, str], ...]
+
+
+class InputOrderError(Exception):
+    pass
+
+
+def layout_swaps(layout: Sequence[str], names: Sequence[str]) -> Optional[list[int]]:
+    '''
+    Swap depths rearranging the stack `names` into `layout` (both bottom to
+    top), `None` if that needs a swap deeper than `MAX_VALID_SWAP_DEPTH`.
+    '''
+    swaps = list(get_swaps(list(layout[::-1]), list(names[::-1])))
+    if any(depth > MAX_VALID_SWAP_DEPTH for depth in swaps):
+        return None
+    return swaps
+
+
+@define
+class StateMetadata:
+    '''
+    Per state lookup tables: how often each value and each name is on the
+    stack and for every node how many stack values and pending effects
+    depend on it. A node nothing depends on is ready to be undone.
+    '''
+    value_counts: dict[EffectfulNode, int]
+    name_counts: dict[str, int]
+    dependents: dict[Node, int]
+
+    @classmethod
+    def of(cls, stack: Stack[EffectfulNode], effects_to_undo: tuple[EffectfulNode, ...]) -> 'StateMetadata':
+        metadata = cls({}, {}, {})
+        metadata.apply(((), tuple(stack), (), effects_to_undo))
+        return metadata
+
+    def copy(self) -> 'StateMetadata':
+        return StateMetadata(self.value_counts.copy(), self.name_counts.copy(), self.dependents.copy())
+
+    def apply(self, delta: StateDelta):
+        removed_values, added_values, removed_effects, added_effects = delta
+        value_counts = self.value_counts
+        name_counts = self.name_counts
+        for value in removed_values:
+            if count := value_counts[value] - 1:
+                value_counts[value] = count
+            else:
+                del value_counts[value]
+            if count := name_counts[value.name] - 1:
+                name_counts[value.name] = count
+            else:
+                del name_counts[value.name]
+            self._depend(value, -1)
+        for value in added_values:
+            value_counts[value] = value_counts.get(value, 0) + 1
+            name_counts[value.name] = name_counts.get(value.name, 0) + 1
+            self._depend(value, 1)
+        for effect in removed_effects:
+            self._depend(effect, -1)
+        for effect in added_effects:
+            self._depend(effect, 1)
+
+    def _depend(self, enode: EffectfulNode, change: int):
+        dependents = self.dependents
+        for dependency in enode.dependencies:
+            if count := dependents.get(dependency, 0) + change:
+                dependents[dependency] = count
+            else:
+                del dependents[dependency]
+
+    def count(self, value: EffectfulNode) -> int:
+        return self.value_counts.get(value, 0)
+
+    def is_ready(self, node: Node) -> bool:
+        return node.is_constant or node not in self.dependents
+
+
+@frozen(cache_hash=True)
+class SearchState:
+    stack: Stack[EffectfulNode]
+    effects_to_undo: tuple[EffectfulNode, ...]
+    # Metadata is derived from the parent's on first use so states that are
+    # generated but never expanded don't pay for it.
+    parent: Optional['SearchState'] = field(default=None, eq=False, repr=False)
+    delta: Optional[StateDelta] = field(default=None, eq=False, repr=False)
+    cached_metadata: Optional[StateMetadata] = field(default=None, eq=False, repr=False)
+
+    @property
+    def metadata(self) -> StateMetadata:
+        if self.cached_metadata is not None:
+            return self.cached_metadata
+        pending: list[SearchState] = []
+        state: Optional[SearchState] = self
+        while state is not None and state.cached_metadata is None:
+            pending.append(state)
+            state = state.parent
+        metadata = None if state is None else state.cached_metadata
+        for state in reversed(pending):
+            if metadata is None:
+                metadata = StateMetadata.of(state.stack, state.effects_to_undo)
+            else:
+                assert state.delta is not None
+                metadata = metadata.copy()
+                metadata.apply(state.delta)
+            object.__setattr__(state, 'cached_metadata', metadata)
+            object.__setattr__(state, 'parent', None)
+            object.__setattr__(state, 'delta', None)
+        assert metadata is not None
+        return metadata
+
+    def count(self, value: EffectfulNode) -> int:
+        return self.metadata.count(value)
+
+    def has_dependency(self, node: Node) -> bool:
+        # Constants are re-pushed on every use so nothing ever blocks them.
+        return not self.metadata.is_ready(node)
+
+    def undo_effect(self, effect: EffectfulNode, swapped: bool = False) -> SearchPath:
+        assert effect in self.effects_to_undo
+        i = self.effects_to_undo.index(effect)
+        new_effects = self.effects_to_undo[:i] + self.effects_to_undo[i+1:]
+
+        ops: list[str] = []
+        new_state = self._undo_node(
+            self.stack,
+            new_effects,
+            ops,
+            effect,
+            self,
+            removed_effect=effect,
+            swapped=swapped
+        )
+        return new_state, 0, ops
+
+    def undo_node(self, enode: EffectfulNode, depth: int, swapped: bool = False) -> SearchPath:
+        stack = self.stack
+        ops = []
+        weight = 0
+        if depth != 0:
+            stack, swap_op = stack.swap(depth)
+            ops.append(swap_op)
+            weight += 1
+        stack, value = stack.pop()
+        assert value == enode
+        new_state = self._undo_node(
+            stack,
+            self.effects_to_undo,
+            ops,
+            enode,
+            self,
+            removed_value=enode,
+            swapped=swapped
+        )
+        return new_state, weight, ops
+
+    def dedup(self, enode: EffectfulNode, depth: int) -> Optional[SearchPath]:
+        '''`None` if no other copy is within `MAX_DUP` slots once `enode` is on top.'''
+        # log.debug(f'Deduping {enode} ({depth}) from {self.stack.values}')
+        stack = self.stack
+        if depth != 0:
+            stack, op = stack.swap(depth)
+            ops = [op]
+            weight = 1
+        else:
+            ops = []
+            weight = 0
+        # Dup from the nearest copy, the state is the same whichever one is used.
+        values = stack.values
+        for dup_depth in range(1, min(MAX_DUP, len(values) - 1) + 1):
+            if values[-1 - dup_depth] == enode:
+                break
+        else:
+            return None
+        stack, popped_value = stack.pop()
+        assert popped_value == enode
+        ops.append(f'dup{dup_depth}')
+
+        new_state = SearchState(stack, self.effects_to_undo, self, ((enode,), (), (), ()))
+
+        return new_state, weight, ops
+
+    @classmethod
+    def _undo_node(
+        cls,
+        stack: Stack[EffectfulNode],
+        effects_to_undo: tuple[EffectfulNode, ...],
+        ops: list[str],
+        enode: EffectfulNode,
+        parent: 'SearchState',
+        removed_value: Optional[EffectfulNode] = None,
+        removed_effect: Optional[EffectfulNode] = None,
+        swapped: bool = False
+    ) -> 'SearchState':
+        '''With `swapped` the operands are pushed in reverse, only valid for commutative ops.'''
+        operands = enode.node.operands
+        stack = stack.push_onto(operands if swapped else operands[::-1])
+        for effect in enode.post_effects:
+            effects_to_undo += (effect,)
+        ops.append(enode.name)
+        delta: StateDelta = (
+            () if removed_value is None else (removed_value,),
+            enode.node.operands,
+            () if removed_effect is None else (removed_effect,),
+            enode.post_effects
+        )
+        return SearchState(stack, effects_to_undo, parent, delta)
+
+
+class ScheduleSearch:
+    '''
+    Successor rules shared by the search engines. The search runs backwards
+    from the outputs and done effects, undoing nodes until only the input
+    symbols are left on the stack.
+    '''
+    target_input_symbols: list[str]
+    input_value_counts: Counter[str]
+
+    free_input_layout: bool
+    input_order: InputOrder
+    layouts: dict[tuple[str, ...], Optional[list[str]]]
+    exact_layouts: bool
+
+    expansions: int
+
+    def _setup(self, target_input_symbols: list[str]):
+        self.target_input_symbols = target_input_symbols
+        self.input_value_counts = Counter(target_input_symbols)
+        self.expansions = 0
+
+        self._setup_input_layout(False, ())
+
+    def _setup_input_layout(self, free_input_layout: bool, input_order: Iterable[Sequence[str]]):
+        '''
+        With a free input layout `target_input_symbols` is only a multiset:
+        every order satisfying `input_order` is an acceptable goal and each
+        goal state completes to its cheapest such layout. Past
+        `MAX_EXHAUSTIVE_LAYOUT` inputs a constrained layout is only a valid
+        one and `exact_layouts` is cleared, weights are then upper bounds.
+        '''
+        self.free_input_layout = free_input_layout
+        self.input_order = tuple((above, below) for above, below in input_order)
+        self.layouts = {}
+        self.exact_layouts = True
+        if self.input_order and not free_input_layout:
+            raise InputOrderError('Input order constraints require a free input layout')
+        for above, below in self.input_order:
+            if above not in self.input_value_counts or below not in self.input_value_counts:
+                raise InputOrderError(f'Constraint ({above!r}, {below!r}) on unknown input')
+            if above == below:
+                raise InputOrderError(f'Input {above!r} constrained against itself')
+        # Raises on contradicting constraints.
+        self._stable_layout(self.target_input_symbols)
+
+
+    #########################
+    ####### SUCCESSORS ######
+    #########################
+
+    def next_states(self, state: SearchState) -> Generator[Optional[SearchPath], None, None]:
+        for path in self.moves(state):
+            if path is not None and self.is_feasible(path[0]):
+                yield path
+
+    def moves(self, state: SearchState) -> Generator[Optional[SearchPath], None, None]:
+        # log.debug(f'Getting next states from: {state}')
+
+        # Undo dup top of stack
+        if (top := state.stack.peek()) is not None:
+            # A constant on top is pushed last, its push is the only move
+            # considered. Constants are never dup'd, re-pushing them gives
+            # the same stack for at most the gas.
+            if top.is_constant:
+                yield from self.undo_node(state, top, 0)
+                return
+            yield self.undo_dup(state, top, 0)
+            yield from self.undo_node(state, top, 0)
+
+        # Undo Effect
+        for effect in state.effects_to_undo:
+            # log.debug(f'undoing effect {effect}')
+            for swapped in self.operand_orders(effect):
+                yield state.undo_effect(effect, swapped)
+
+        # Undo Node / Undo Dup, legality is decided once per distinct value.
+        # Deeper slots are out of reach of swap16.
+        tail = state.stack.tail()[-MAX_VALID_SWAP_DEPTH:]
+        metadata = state.metadata
+        undoable, dedupable = self.movable_values(metadata, set(tail))
+        for depth, value in enumerate(reversed(tail), start=1):
+            if value in undoable:
+                for swapped in self.operand_orders(value):
+                    yield state.undo_node(value, depth, swapped)
+        for depth, value in enumerate(reversed(tail), start=1):
+            if value in dedupable:
+                yield state.dedup(value, depth)
+
+        # log.debug(f'End of next states')
+        # TODO: pops
+
+    def movable_values(
+        self,
+        metadata: StateMetadata,
+        values: Iterable[EffectfulNode]
+    ) -> tuple[set[EffectfulNode], set[EffectfulNode]]:
+        '''Splits `values` into the ones whose node can be undone and the ones that can be deduped.'''
+        undoable: set[EffectfulNode] = set()
+        dedupable: set[EffectfulNode] = set()
+        value_counts = metadata.value_counts
+        for value in values:
+            if not metadata.is_ready(value.node):
+                continue
+            count = value_counts[value]
+            if value.is_constant:
+                if not self.is_input_symbol(value):
+                    undoable.add(value)
+            elif count == 1:
+                if not self.is_input_symbol(value):
+                    undoable.add(value)
+            elif self.input_value_counts[value.name] < count:
+                dedupable.add(value)
+        return undoable, dedupable
+
+    def is_feasible(self, state: SearchState) -> bool:
+        '''
+        Cheap necessary condition for reaching the end from `state`. Every
+        value that isn't an input has to get to the top at some point, so at
+        most `MAX_VALID_SWAP_DEPTH` values may stay above it. Copies of an
+        input can only be deduped while more than the required number are
+        on the stack. The ones above a value that can never be removed stay
+        above it until it's in reach. End states have to be in swap reach of
+        their input layout.
+        '''
+        if self.is_end(state):
+            return self.completion_swaps(state) is not None
+        values = state.stack.values
+        if len(values) <= MAX_VALID_SWAP_DEPTH + 1:
+            return True
+        name_counts = state.metadata.name_counts
+        below: dict[str, int] = {}
+        for value in values:
+            name = value.name
+            if name not in self.input_value_counts:
+                stuck_above = 0
+                for input_name, required in self.input_value_counts.items():
+                    input_below = below.get(input_name, 0)
+                    input_above = name_counts.get(input_name, 0) - input_below
+                    stuck_above += min(input_above, max(0, required - input_below))
+                if stuck_above > MAX_VALID_SWAP_DEPTH:
+                    return False
+            below[name] = below.get(name, 0) + 1
+        return True
+
+    def undo_node(self, state: SearchState, enode: EffectfulNode, depth: int) -> Iterator[SearchPath]:
+        if not self.can_undo_node(state.metadata, enode):
+            return
+        # log.debug(f'undoing node {enode}')
+        for swapped in self.operand_orders(enode):
+            yield state.undo_node(enode, depth, swapped)
+
+    def operand_orders(self, enode: EffectfulNode) -> tuple[bool, ...]:
+        '''
+        Operands of commutative ops may be pushed in either order, the
+        swapped order is skipped if it leads to the same state.
+        '''
+        operands = enode.node.operands
+        if len(operands) == 2 and operands[0] != operands[1] and is_commutative(enode.name):
+            return BOTH_ORDERS
+        return DECLARED_ORDER
+
+    def can_undo_node(self, metadata: StateMetadata, enode: EffectfulNode) -> bool:
+        if self.is_input_symbol(enode):
+            return False
+        if not enode.is_constant and metadata.count(enode) > 1:
+            return False
+        return metadata.is_ready(enode.node)
+
+    def is_input_symbol(self, enode: EffectfulNode) -> bool:
+        return enode.name in self.target_input_symbols
+
+    def undo_dup(self, state: SearchState, enode: EffectfulNode, depth: int) -> Optional[SearchPath]:
+        if not self.can_undo_dup(state.metadata, enode):
+            return None
+        # log.debug(f'deduping {enode} at depth {depth}')
+        return state.dedup(enode, depth)
+
+    def can_undo_dup(self, metadata: StateMetadata, enode: EffectfulNode) -> bool:
+        if enode.is_constant:
+            return False
+        count = metadata.count(enode)
+        if count == 1:
+            return False
+        if self.input_value_counts[enode.name] >= count:
+            return False
+        return metadata.is_ready(enode.node)
+
+    def complete_for_end(self, state: SearchState, ops: list[str]) -> tuple[bool, int]:
+        if not self.is_end(state):
+            return False, 0
+
+        swaps = self.completion_swaps(state)
+        if swaps is None:
+            return False, 0
+        ops.extend(f'swap{depth}' for depth in swaps)
+
+        return True, len(swaps)
+
+    def completion_swaps(self, state: SearchState) -> Optional[list[int]]:
+        '''Swaps completing the end `state`, `None` if it can't be completed.'''
+        layout = self.input_layout_for(state)
+        if layout is None:
+            return None
+        return layout_swaps(layout, [value.name for value in state.stack])
+
+    #########################
+    ##### INPUT LAYOUT ######
+    #########################
+
+    def input_layout_for(self, state: SearchState) -> Optional[list[str]]:
+        '''Input layout (bottom to top) the end `state` is completed to.'''
+        if not self.free_input_layout:
+            return self.target_input_symbols
+        names = tuple(value.name for value in state.stack)
+        if (layout := self.layouts.get(names)) is None:
+            layout = self.layouts[names] = self._cheapest_layout(list(names))
+        return layout
+
+    def satisfies_input_order(self, layout: Sequence[str]) -> bool:
+        lowest: dict[str, int] = {}
+        highest: dict[str, int] = {}
+        for i, name in enumerate(layout):
+            lowest.setdefault(name, i)
+            highest[name] = i
+        return all(lowest[above] > highest[below] for above, below in self.input_order)
+
+    def _cheapest_layout(self, names: list[str]) -> Optional[list[str]]:
+        '''`None` if no layout satisfying `input_order` is within swap reach.'''
+        if self.satisfies_input_order(names):
+            return names
+        if len(names) > MAX_EXHAUSTIVE_LAYOUT:
+            self.exact_layouts = False
+            layout = self._stable_layout(names)
+            return layout if layout_swaps(layout, names) is not None else None
+        costs = (
+            (len(swaps), list(layout))
+            for layout in set(permutations(names))
+            if self.satisfies_input_order(layout)
+            and (swaps := layout_swaps(layout, names)) is not None
+        )
+        return min(costs, key=lambda cost: cost[0], default=(0, None))[1]
+
+    def _stable_layout(self, names: list[str]) -> list[str]:
+        '''Layout satisfying `input_order` that keeps `names` in place where it can.'''
+        must_be_above: dict[str, set[str]] = {name: set() for name in names}
+        for above, below in self.input_order:
+            must_be_above[above].add(below)
+        remaining = Counter(names)
+        layout: list[str] = []
+        pending = list(names)
+        while pending:
+            for i, name in enumerate(pending):
+                if not any(remaining[below] for below in must_be_above[name]):
+                    break
+            else:
+                raise InputOrderError(f'Contradicting input order constraints {self.input_order}')
+            layout.append(pending.pop(i))
+            remaining[name] -= 1
+        return layout
+
+    def is_end(self, state: SearchState) -> bool:
+        if state.effects_to_undo or len(state.stack) != len(self.target_input_symbols):
+            return False
+
+        return state.metadata.name_counts == self.input_value_counts
@@ -0,0 +1,126 @@
+from typing import Iterable
+from .node import EffectfulNode, Node
+
+
+# [name, is_constant, [operand enode ids]]
+EncodedNode = tuple[str, bool, tuple[int, ...]]
+# [node id, [post effect enode ids]]
+EncodedEffectfulNode = tuple[int, tuple[int, ...]]
+
+
+class NodeTable:
+    '''
+    Flat, JSON-compatible encoding of an `EffectfulNode` DAG. Nodes and
+    effectful nodes are referenced by their index in the respective list,
+    shared sub-nodes are only encoded once.
+    '''
+    nodes: list[EncodedNode]
+    enodes: list[EncodedEffectfulNode]
+    node_ids: dict[Node, int]
+    enode_ids: dict[EffectfulNode, int]
+
+    def __init__(self, roots: Iterable[EffectfulNode] = tuple()) -> None:
+        self.nodes = []
+        self.enodes = []
+        self.node_ids = {}
+        self.enode_ids = {}
+        for root in roots:
+            self.add(root)
+
+    def add(self, enode: EffectfulNode) -> int:
+        # Post-order walk on an explicit stack, deep DAGs would overflow the
+        # interpreter stack. Ids are assigned in the same order as a
+        # recursive walk: node (operands first), post effects, enode.
+        work: list[tuple[EffectfulNode | Node, bool]] = [(enode, False)]
+        while work:
+            item, children_added = work.pop()
+            if isinstance(item, EffectfulNode):
+                if item in self.enode_ids:
+                    continue
+                if children_added:
+                    post = tuple(self.enode_ids[effect] for effect in item.post_effects)
+                    self.enode_ids[item] = len(self.enodes)
+                    self.enodes.append((self.node_ids[item.node], post))
+                    continue
+                work.append((item, True))
+                work.extend((effect, False) for effect in reversed(item.post_effects))
+                work.append((item.node, False))
+            else:
+                if item in self.node_ids:
+                    continue
+                if children_added:
+                    operands = tuple(self.enode_ids[operand] for operand in item.operands)
+                    self.node_ids[item] = len(self.nodes)
+                    self.nodes.append((item.name, item.is_constant, operands))
+                    continue
+                work.append((item, True))
+                work.extend((operand, False) for operand in reversed(item.operands))
+        return self.enode_ids[enode]
+
+    def ids(self, enodes: Iterable[EffectfulNode]) -> tuple[int, ...]:
+        return tuple(self.add(enode) for enode in enodes)
+
+    def to_json(self) -> dict:
+        return {
+            'nodes': [[name, is_constant, list(operands)] for name, is_constant, operands in self.nodes],
+            'enodes': [[node_id, list(post)] for node_id, post in self.enodes],
+        }
+
+
+class NodeDecodeError(Exception):
+    pass
+
+
+def expand(work: list[tuple[bool, int]], expanded: set[tuple[bool, int]], missing: list[tuple[bool, int]]):
+    # Everything an item references is built before it's looked at again.
+    if (item := work[-1]) in expanded:
+        raise NodeDecodeError(f'Cycle through {"enode" if item[0] else "node"} {item[1]}')
+    expanded.add(item)
+    work.extend(missing)
+
+
+def decode_nodes(data: dict) -> list[EffectfulNode]:
+    encoded_nodes = data['nodes']
+    encoded_enodes = data['enodes']
+    nodes: dict[int, Node] = {}
+    enodes: dict[int, EffectfulNode] = {}
+
+    # (is enode, id), built once everything it references is built.
+    work: list[tuple[bool, int]] = []
+    expanded: set[tuple[bool, int]] = set()
+    for root in range(len(encoded_enodes)):
+        work.append((True, root))
+        while work:
+            is_enode, item_id = work[-1]
+            if is_enode:
+                if item_id in enodes:
+                    work.pop()
+                    continue
+                node_id, post = encoded_enodes[item_id]
+                missing = [(True, i) for i in post if i not in enodes]
+                if node_id not in nodes:
+                    missing.append((False, node_id))
+                if missing:
+                    expand(work, expanded, missing)
+                    continue
+                work.pop()
+                enodes[item_id] = EffectfulNode(
+                    nodes[node_id],
+                    post_effects=tuple(enodes[i] for i in post)
+                )
+            else:
+                if item_id in nodes:
+                    work.pop()
+                    continue
+                name, is_constant, operands = encoded_nodes[item_id]
+                if missing := [(True, i) for i in operands if i not in enodes]:
+                    expand(work, expanded, missing)
+                    continue
+                work.pop()
+                nodes[item_id] = Node(
+                    name,
+                    *(enodes[i] for i in operands),
+                    is_constant=is_constant
+                )
+
+    return [enodes[i] for i in range(len(encoded_enodes))]
@@ -0,0 +1,291 @@
+'''
+Long-running local scheduling service.
+
+Requests are newline delimited JSON objects sent over a Unix socket or
+localhost TCP connection, each answered by exactly one JSON line in order:
+
+    -> {"inputs": [...], "outputs": [...], "effects": [...], "nodes": {...}}
+    <- {"weight": 3, "solution": ["0x24", "calldataload", ...], "aborted": false}
+    <- {"error": "..."}
+
+`outputs` and `effects` are ids into the `nodes` table (see `NodeTable`).
+`aborted` results are valid but not necessarily optimal schedules.
+Identical in-flight requests are coalesced into a single search and
+results are kept in a shared in-memory cache.
+'''
+import argparse
+import asyncio
+import json
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Optional, Sequence
+from attrs import frozen
+from .dijkstra import DijkstraSchedule
+from .node import EffectfulNode
+from .serialize import NodeTable, decode_nodes
+
+
+MAX_LINE_LENGTH = 64 * 1024 * 1024
+DEFAULT_CACHE_SIZE = 4096
+
+
+@frozen
+class ScheduleRequest:
+    target_input_symbols: tuple[str, ...]
+    start_output_stack: tuple[int, ...]
+    start_done_effects: tuple[int, ...]
+    nodes: dict
+
+    @classmethod
+    def from_nodes(
+        cls,
+        target_input_symbols: Sequence[str],
+        start_output_stack: Sequence[EffectfulNode],
+        start_done_effects: Sequence[EffectfulNode],
+    ) -> 'ScheduleRequest':
+        table = NodeTable()
+        outputs = table.ids(start_output_stack)
+        effects = table.ids(start_done_effects)
+        return cls(tuple(target_input_symbols), outputs, effects, table.to_json())
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'ScheduleRequest':
+        return cls(
+            tuple(data['inputs']),
+            tuple(data['outputs']),
+            tuple(data['effects']),
+            data['nodes']
+        )
+
+    def to_json(self) -> dict:
+        return {
+            'inputs': list(self.target_input_symbols),
+            'outputs': list(self.start_output_stack),
+            'effects': list(self.start_done_effects),
+            'nodes': self.nodes,
+        }
+
+    def key(self) -> str:
+        return json.dumps(self.to_json(), sort_keys=True, separators=(',', ':'))
+
+
+@frozen
+class ScheduleResult:
+    weight: int
+    solution: tuple[str, ...]
+    aborted: bool = False
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'ScheduleResult':
+        return cls(data['weight'], tuple(data['solution']), data.get('aborted', False))
+
+    def to_json(self) -> dict:
+        return {'weight': self.weight, 'solution': list(self.solution), 'aborted': self.aborted}
+
+
+class ScheduleError(Exception):
+    pass
+
+
+def solve(request: ScheduleRequest) -> ScheduleResult:
+    enodes = decode_nodes(request.nodes)
+    scheduler = DijkstraSchedule(
+        list(request.target_input_symbols),
+        [enodes[i] for i in request.start_output_stack],
+        [enodes[i] for i in request.start_done_effects],
+    )
+    if scheduler.solution is None or scheduler.best_weight is None:
+        raise ScheduleError('No schedule reaches the target input symbols')
+    return ScheduleResult(scheduler.best_weight, tuple(scheduler.solution), scheduler.aborted)
+
+
+class SchedulingService:
+    '''
+    Dispatches requests to `executor`, a process pool by default. With
+    `inline=True` searches run directly on the event loop instead.
+    '''
+    executor: Optional[Executor]
+    cache_size: int
+    cache: OrderedDict[str, ScheduleResult]
+    in_flight: dict[str, asyncio.Future[ScheduleResult]]
+    searches_started: int
+
+    def __init__(
+        self,
+        executor: Optional[Executor] = None,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+        inline: bool = False
+    ) -> None:
+        if executor is None and not inline:
+            executor = ProcessPoolExecutor()
+        self.executor = executor
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.in_flight = {}
+        self.searches_started = 0
+
+    async def schedule(self, request: ScheduleRequest) -> ScheduleResult:
+        key = request.key()
+        if (result := self.cache.get(key)) is not None:
+            self.cache.move_to_end(key)
+            return result
+        if (pending := self.in_flight.get(key)) is None:
+            pending = self.in_flight[key] = asyncio.ensure_future(self._run(key, request))
+        # Shield so one cancelled client doesn't cancel the search for others.
+        return await asyncio.shield(pending)
+
+    async def _run(self, key: str, request: ScheduleRequest) -> ScheduleResult:
+        self.searches_started += 1
+        try:
+            if self.executor is None:
+                result = solve(request)
+            else:
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(self.executor, solve, request)
+        finally:
+            del self.in_flight[key]
+        self.cache[key] = result
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                response: dict[str, Any]
+                try:
+                    result = await self.schedule(ScheduleRequest.from_json(json.loads(line)))
+                    response = result.to_json()
+                except Exception as e:
+                    response = {'error': f'{type(e).__name__}: {e}'}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve_unix(self, path: str) -> asyncio.AbstractServer:
+        return await asyncio.start_unix_server(self.handle_connection, path, limit=MAX_LINE_LENGTH)
+
+    async def serve_tcp(self, host: str = '127.0.0.1', port: int = 0) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle_connection, host, port, limit=MAX_LINE_LENGTH)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class SchedulerClient:
+    '''
+    Thin async client for a running `SchedulingService`. Connect either via
+    `path` (Unix socket) or `host`/`port`.
+    '''
+    path: Optional[str]
+    host: str
+    port: Optional[int]
+    reader: Optional[asyncio.StreamReader]
+    writer: Optional[asyncio.StreamWriter]
+    lock: asyncio.Lock
+
+    def __init__(self, path: Optional[str] = None, host: str = '127.0.0.1', port: Optional[int] = None) -> None:
+        assert (path is None) != (port is None), 'Expected exactly one of path or port'
+        self.path = path
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        if self.path is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=MAX_LINE_LENGTH)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=MAX_LINE_LENGTH)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.reader = self.writer = None
+
+    async def __aenter__(self) -> 'SchedulerClient':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def schedule(
+        self,
+        target_input_symbols: Sequence[str],
+        start_output_stack: Sequence[EffectfulNode],
+        start_done_effects: Sequence[EffectfulNode],
+    ) -> ScheduleResult:
+        request = ScheduleRequest.from_nodes(target_input_symbols, start_output_stack, start_done_effects)
+        return await self.schedule_request(request)
+
+    async def schedule_request(self, request: ScheduleRequest) -> ScheduleResult:
+        # Responses come back in request order, one request per connection at a time.
+        async with self.lock:
+            if self.writer is None:
+                await self.connect()
+            assert self.reader is not None and self.writer is not None
+            self.writer.write(json.dumps(request.to_json()).encode() + b'\n')
+            await self.writer.drain()
+            line = await self.reader.readline()
+        if not line:
+            raise ScheduleError('Connection closed by service')
+        response = json.loads(line)
+        if 'error' in response:
+            raise ScheduleError(response['error'])
+        return ScheduleResult.from_json(response)
+
+
+class LocalSchedulerClient(SchedulerClient):
+    '''
+    In-process stand-in for `SchedulerClient`, e.g. for tests. Requests still
+    go through the JSON encoding and a `SchedulingService` but no socket.
+    '''
+    service: SchedulingService
+
+    def __init__(self, service: Optional[SchedulingService] = None) -> None:
+        self.service = SchedulingService(inline=True) if service is None else service
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def schedule_request(self, request: ScheduleRequest) -> ScheduleResult:
+        request = ScheduleRequest.from_json(json.loads(json.dumps(request.to_json())))
+        return await self.service.schedule(request)
+
+
+async def _serve(args: argparse.Namespace):
+    service = SchedulingService(
+        ProcessPoolExecutor(max_workers=args.workers),
+        cache_size=args.cache_size
+    )
+    if args.socket is not None:
+        server = await service.serve_unix(args.socket)
+    else:
+        server = await service.serve_tcp(args.host, args.port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local DAG scheduling service')
+    parser.add_argument('--socket', help='Unix socket path to listen on')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7545)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE)
+    asyncio.run(_serve(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+from typing import Iterable, NamedTuple, Optional, Sequence
+from .node import EffectfulNode
+from .opcodes import is_commutative, parse_stack_op
+
+
+class Signature(NamedTuple):
+    inputs: int
+    outputs: int
+    is_constant: bool = False
+
+
+class SignatureError(Exception):
+    pass
+
+
+def op_signatures(
+    start_output_stack: Iterable[EffectfulNode],
+    start_done_effects: Iterable[EffectfulNode]
+) -> dict[str, Signature]:
+    '''
+    Stack signatures of the ops a schedule for the given DAG may emit: values
+    push one result, effects (done effects and post effects) push nothing.
+    '''
+    signatures: dict[str, Signature] = {}
+    seen: set[tuple[EffectfulNode, int]] = set()
+    # Explicit stack, deep DAGs would overflow the interpreter stack.
+    work: list[tuple[EffectfulNode, int]] = [(effect, 0) for effect in reversed(list(start_done_effects))]
+    work.extend((value, 1) for value in reversed(list(start_output_stack)))
+    while work:
+        enode, outputs = work.pop()
+        if (enode, outputs) in seen:
+            continue
+        seen.add((enode, outputs))
+        signature = Signature(len(enode.node.operands), outputs, enode.is_constant)
+        if signatures.setdefault(enode.name, signature) != signature:
+            raise SignatureError(
+                f'Conflicting signatures for {enode.name!r}: {signature} and {signatures[enode.name]}'
+            )
+        work.extend((effect, 0) for effect in reversed(enode.post_effects))
+        work.extend((operand, 1) for operand in reversed(enode.node.operands))
+
+    return signatures
+
+
+class SimulationError(Exception):
+    pass
+
+
+class StackSimulator:
+    '''
+    Symbolic EVM stack. Values are hash-consed terms (ints) so two op
+    sequences compute the same values iff they end with the same `stack`
+    and `log`. Operands of commutative ops are canonicalized by sorting.
+    Constants are treated as pure, every other op is recorded in `log`
+    together with its operands in execution order.
+
+    Reading below the bottom of `stack` materializes fresh input values
+    unless the simulator is `closed`.
+    '''
+    signatures: dict[str, Signature]
+    stack: list[int]
+    log: list[tuple[str, tuple[int, ...]]]
+    terms: dict[tuple, int]
+    inputs_used: int
+    closed: bool
+
+    def __init__(
+        self,
+        signatures: dict[str, Signature],
+        input_stack: Optional[Sequence[str]] = None,
+        terms: Optional[dict[tuple, int]] = None
+    ) -> None:
+        self.signatures = signatures
+        self.terms = {} if terms is None else terms
+        self.log = []
+        self.inputs_used = 0
+        self.closed = input_stack is not None
+        self.stack = []
+        if input_stack is not None:
+            self.stack = [self.term('$input', name) for name in input_stack]
+
+    def term(self, *key) -> int:
+        if (term := self.terms.get(key)) is None:
+            term = self.terms[key] = len(self.terms)
+        return term
+
+    def _reach(self, depth: int):
+        '''Ensures the stack holds at least `depth + 1` values.'''
+        if len(self.stack) <= depth:
+            if self.closed:
+                raise SimulationError(f'Stack underflow (depth {depth}, height {len(self.stack)})')
+            self._use_inputs(self.inputs_used + depth + 1 - len(self.stack))
+
+    def _use_inputs(self, inputs: int):
+        while self.inputs_used < inputs:
+            self.stack.insert(0, self.term('$below', self.inputs_used))
+            self.inputs_used += 1
+
+    def run(self, ops: Iterable[str]) -> 'StackSimulator':
+        for op in ops:
+            self.step(op)
+        return self
+
+    def step(self, op: str):
+        if (parsed := parse_stack_op(op)) is not None:
+            kind, n = parsed
+            if kind == 'swap':
+                self._reach(n)
+                self.stack[-1], self.stack[-n-1] = self.stack[-n-1], self.stack[-1]
+            else:
+                self._reach(n - 1)
+                self.stack.append(self.stack[-n])
+            return
+
+        if (signature := self.signatures.get(op)) is None:
+            raise SimulationError(f'Unknown op {op!r}')
+        if signature.inputs:
+            self._reach(signature.inputs - 1)
+        operands = tuple(reversed(self.stack[len(self.stack) - signature.inputs:]))
+        del self.stack[len(self.stack) - signature.inputs:]
+        if signature.inputs == 2 and is_commutative(op):
+            operands = tuple(sorted(operands))
+        if not signature.is_constant:
+            self.log.append((op, operands))
+        if signature.outputs:
+            # Non-constant values are identified by their position in the log.
+            key = (op,) if signature.is_constant else (op, operands, len(self.log))
+            self.stack.append(self.term(*key))
+
+    def result(self) -> tuple[tuple[int, ...], tuple[tuple[str, tuple[int, ...]], ...], int]:
+        return tuple(self.stack), tuple(self.log), self.inputs_used
+
+
+def equivalent(ops_a: Sequence[str], ops_b: Sequence[str], signatures: dict[str, Signature]) -> bool:
+    '''Whether the two op sequences have the same effect on any stack.'''
+    terms: dict[tuple, int] = {}
+    try:
+        a = StackSimulator(signatures, terms=terms).run(ops_a)
+        b = StackSimulator(signatures, terms=terms).run(ops_b)
+    except SimulationError:
+        return False
+    # Pad to a common depth so reading deeper in one sequence doesn't matter.
+    a._use_inputs(b.inputs_used)
+    b._use_inputs(a.inputs_used)
+    return a.result() == b.result()